@@ -0,0 +1,198 @@
+#################################################################################
+# Reader for SQLite-MegaMerge-for-CellProfiler                                  #
+#                                                                               #
+# @description    Reads merged databases into NumPy arrays in fixed-size        #
+#                 chunks, so that screens with billions of objects can be       #
+#                 processed without loading whole tables into memory.           #
+#                 Import it from your own scripts or notebooks, i.e.            #
+#                                                                               #
+#                 from MegaMergeReader import read_chunks                       #
+#                 for keys, chunk in read_chunks('merged.db', 'Per_Object',     #
+#                                                ['Nuclei_AreaShape_Area']):    #
+#                     ...                                                       #
+#                                                                               #
+#################################################################################
+
+#################################################################################
+############################## Import Libraries #################################
+
+import os
+import sqlite3
+import numpy as np
+from urllib.request import pathname2url
+
+#################################################################################
+############################## Define Functions #################################
+
+# 1. Open a merged database read-only
+#
+# @param db_name the name of the database file (i.e. "merged.db")
+# @return a sqlite3 connection, several reader processes can each open their own
+
+def open_database(db_name):
+    return sqlite3.connect(f"file:{pathname2url(os.path.abspath(db_name))}?mode=ro", uri = True)
+
+# 2. Get the key columns used to read a table in order
+#
+# @param conn an open connection
+# @param table_name the name of the table or view (i.e. "Per_Object")
+# @return the primary key columns of the table (i.e. ["ImageNumber", "ObjectNumber"] for a clustered Per_Object),
+#         ImageNumber and ObjectNumber for a view that has them (i.e. a partitioned Per_Object or a grouped Per_Image),
+#         otherwise ["rowid"] (a view has no rowid, and ImageNumber, ObjectNumber is the key order of the tables under it)
+
+def get_key_columns(conn, table_name):
+    info = conn.execute(f"PRAGMA table_info({table_name});").fetchall()
+    pk = sorted([row for row in info if row[5] > 0], key = lambda row: row[5])
+    if len(pk) > 0:
+        return [row[1] for row in pk]
+    names = [row[1] for row in info]
+    view = conn.execute(f"SELECT COUNT(*) FROM sqlite_master WHERE type = 'view' AND name = '{table_name}';").fetchone()[0]
+    keys = [col for col in ["ImageNumber", "ObjectNumber"] if col in names]
+    if (view > 0 and len(keys) > 0):
+        return keys
+    return ["rowid"]
+
+# 3. Get the numeric columns of a table
+#
+# @param conn an open connection
+# @param table_name the name of the table or view
+# @return a string array of the INTEGER and REAL columns
+
+def get_numeric_columns(conn, table_name):
+    columns = []
+    for row in conn.execute(f"PRAGMA table_info({table_name});").fetchall():
+        coltype = row[2].upper()
+        if ("INT" in coltype or "REAL" in coltype or "FLOA" in coltype or "DOUB" in coltype):
+            columns.append(row[1])
+    return columns
+
+# 4. Split the key range of a table into disjoint parts for parallel readers
+#
+# @param db_name the name of the database file
+# @param table_name the name of the table or view
+# @param n_parts the number of parts (i.e. the number of reader processes)
+# @param key_column the column to split on, the first key column by default (ImageNumber, ObjectNumber or rowid)
+# @return a list of [start, stop) pairs covering the whole table, to pass to read_chunks or read_packed
+# parts have equal widths in key space, not necessarily the same number of rows
+
+def split_key_range(db_name, table_name, n_parts, key_column=None):
+    conn = open_database(db_name)
+    if key_column is None:
+        key_column = get_key_columns(conn, table_name)[0]
+    lo, hi = conn.execute(f"SELECT MIN({key_column}), MAX({key_column}) FROM {table_name};").fetchone()
+    conn.close()
+    if lo is None:
+        return []
+    bounds = [int(lo) + (int(hi) + 1 - int(lo)) * k // n_parts for k in range(0, n_parts + 1)]
+    return [[bounds[k], bounds[k + 1]] for k in range(0, n_parts) if bounds[k] < bounds[k + 1]]
+
+# 5. Iterate over the rows of a table in key order, in batches
+#
+# @param conn an open connection
+# @param table_name the name of the table or view
+# @param select the columns to select (the key columns are selected first, before these)
+# @param key_columns the columns the table is read in order of
+# @param start, stop optional [start, stop) range of the first key column
+# @param batch_size the number of rows fetched at a time
+# @return a generator of lists of rows
+# uses keyset pagination (WHERE key > last key), so every batch is a range scan of the key index
+# and the position in the table is never lost or re-scanned
+
+def iterate_rows(conn, table_name, select, key_columns, start, stop, batch_size):
+    keys = ", ".join(key_columns)
+    columns = ", ".join(key_columns + select)
+    where = []
+    params = []
+    if start is not None:
+        where.append(f"{key_columns[0]} >= ?")
+        params.append(start)
+    if stop is not None:
+        where.append(f"{key_columns[0]} < ?")
+        params.append(stop)
+    last = None
+    while True:
+        clauses = list(where)
+        values = list(params)
+        if last is not None:
+            clauses.append(f"({keys}) > ({', '.join(['?'] * len(key_columns))})")
+            values = values + list(last)
+        condition = "" if len(clauses) == 0 else " WHERE " + " AND ".join(clauses)
+        rows = conn.execute(f"SELECT {columns} FROM {table_name}{condition} ORDER BY {keys} LIMIT {batch_size};", values).fetchall()
+        if len(rows) == 0:
+            return
+        yield rows
+        last = rows[-1][:len(key_columns)]
+
+# 6. Read a table in chunks into preallocated NumPy arrays
+#
+# @param db_name the name of the database file
+# @param table_name the name of the table or view (i.e. "Per_Object" or "Per_Image")
+# @param columns the columns to read, all numeric columns by default
+# @param start, stop optional [start, stop) range of the first key column, i.e. from split_key_range
+# @param max_bytes the memory ceiling for the chunk array (default 256 MB)
+# @param dtype the array type, NULL values become NaN for float types
+# @param key_columns the columns to read the table in order of, see get_key_columns by default
+# @return a generator of (keys, values) arrays of at most max_bytes, keys is int64 with one column per key column
+# the same two arrays are reused for every chunk, so copy them if you keep a chunk after the next one is read
+
+def read_chunks(db_name, table_name, columns=None, start=None, stop=None, max_bytes=256 * 2**20, dtype=np.float64, key_columns=None):
+    conn = open_database(db_name)
+    if key_columns is None:
+        key_columns = get_key_columns(conn, table_name)
+    if columns is None:
+        columns = [col for col in get_numeric_columns(conn, table_name) if col not in key_columns]
+    nkeys = len(key_columns)
+    chunk_rows = max(1, max_bytes // (len(columns) * np.dtype(dtype).itemsize + nkeys * 8))
+    keys = np.empty((chunk_rows, nkeys), dtype = np.int64)
+    values = np.empty((chunk_rows, len(columns)), dtype = dtype)
+    n = 0
+    for rows in iterate_rows(conn, table_name, columns, key_columns, start, stop, min(chunk_rows, 4096)):
+        if n + len(rows) > chunk_rows:
+            yield keys[:n], values[:n]
+            n = 0
+        keys[n:n + len(rows)] = [row[:nkeys] for row in rows]
+        values[n:n + len(rows)] = [row[nkeys:] for row in rows]
+        n += len(rows)
+    if n > 0:
+        yield keys[:n], values[:n]
+    conn.close()
+
+# 7. Read the packed feature vectors (see pack_features in MegaMergeScript.py) in chunks
+#
+# @param db_name the name of the database file
+# @param start, stop optional [start, stop) rowid range of Per_Object_Packed, i.e. from split_key_range
+# @param max_bytes the memory ceiling for the chunk array (default 256 MB)
+# @return a generator of (keys, vectors) arrays, keys holds ImageNumber and ObjectNumber,
+#         vectors is float32 with columns in the order of get_packed_columns
+# the blobs are copied straight into the preallocated array without parsing values one by one,
+# the same two arrays are reused for every chunk
+
+def read_packed(db_name, start=None, stop=None, max_bytes=256 * 2**20):
+    columns = get_packed_columns(db_name)
+    conn = open_database(db_name)
+    chunk_rows = max(1, max_bytes // (len(columns) * 4 + 16))
+    keys = np.empty((chunk_rows, 2), dtype = np.int64)
+    vectors = np.empty((chunk_rows, len(columns)), dtype = '<f4')
+    n = 0
+    for rows in iterate_rows(conn, "Per_Object_Packed", ["ImageNumber", "ObjectNumber", "Features"], ["rowid"],
+                             start, stop, min(chunk_rows, 4096)):
+        if n + len(rows) > chunk_rows:
+            yield keys[:n], vectors[:n]
+            n = 0
+        keys[n:n + len(rows)] = [row[1:3] for row in rows]
+        vectors[n:n + len(rows)] = np.frombuffer(b"".join([row[3] for row in rows]), dtype = '<f4').reshape(len(rows), len(columns))
+        n += len(rows)
+    if n > 0:
+        yield keys[:n], vectors[:n]
+    conn.close()
+
+# 8. Get the feature names of the packed vectors, in order
+#
+# @param db_name the name of the database file
+# @return a string array of column names from Per_Object_Packed_Columns
+
+def get_packed_columns(db_name):
+    conn = open_database(db_name)
+    columns = [row[0] for row in conn.execute("SELECT ColumnName FROM Per_Object_Packed_Columns ORDER BY Position;").fetchall()]
+    conn.close()
+    return columns
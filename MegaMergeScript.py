@@ -21,8 +21,17 @@ import time
 import sys
 import traceback
 import os
+import shutil
+import json
+import hashlib
+import multiprocessing
+import warnings
+import numpy as np
 import pandas as pd
 from time import gmtime, strftime
+from collections import deque
+from urllib.request import pathname2url
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 #################################################################################
 ############################## Global Variables #################################
@@ -30,6 +39,8 @@ from time import gmtime, strftime
 dbCount = 0  # Variable to count the number of databases
 listDB = []  # Variable to store the names of the databases
 listTable = []  # Variable to store table names
+run_metrics = {}  # Variable to store run metrics, written to metrics_file at the end of the merge
+runStartTime = time.time()  # Variable to store when the run started, startTime is reset by each section
 
 #################################################################################
 ############################## (1) Define Functions #############################
@@ -140,15 +151,21 @@ def list_to_string(list_obj, dim):
 # @param table_name the name of the table to merge
 # @param column_names the names of the columns to include in the merge
 # @param db_name_table_name the name of the attached database and the table i.e. "db_name.table_name"
-# @return none
+# @param order_by optional columns to insert the rows in order of (i.e. the key of a clustered table)
+# @param select_names optional expressions to select for column_names, i.e. with NULL for columns the donor lacks (see 1.38)
+# @return True if the rows were merged, False if the insert failed
 
-def merge_table(table_name, column_names, db_name):
+def merge_table(table_name, column_names, db_name, order_by=None, select_names=None):
     db_name_table_name = db_name + "." + table_name
+    order = "" if order_by is None else f" ORDER BY {order_by}"
+    select_names = column_names if select_names is None else select_names
     try:
-        curs.execute(f"INSERT INTO {table_name}({column_names}) SELECT {column_names} FROM {db_name_table_name};")
+        curs.execute(f"INSERT INTO {table_name}({column_names}) SELECT {select_names} FROM {db_name_table_name}{order};")
         conn.commit()
+        return True
     except Exception:
         traceback.print_exc()
+        return False
 
 
 # 1.8 Divide otherDBs into blocks of ten or less because sqlite can't attach more than ten at a time
@@ -254,6 +271,1020 @@ def swap_column_names(table, col1, col2):
     rename_column(table, col1_, col2)
     rename_column(table, col2_, col1)
 
+# 1.14 Get the row count and order-independent checksums of the ID columns of a table
+#
+# @param table_name the name of the table
+# @param id_columns the ID columns to checksum, columns missing from the table are skipped
+# @param db_name the name of the (attached) database holding the table, i.e. "main" or "db_0_1"
+# @return a dict {"rows": count, "<column>": [non-null count, sum, sum of squares], ...}
+# sums are taken modulo a prime so that billions of rows can not overflow sqlite's 64 bit integers,
+# and the whole thing is computed in a single scan of the table
+
+def get_table_aggregates(table_name, id_columns, db_name="main"):
+    curs.execute(f"PRAGMA {db_name}.table_info({table_name});")
+    present = [row[1] for row in curs.fetchall()]
+    columns = [col for col in id_columns if col in present]
+    select = ["COUNT(*)"]
+    for col in columns:
+        select.append(f"COUNT({col})")
+        select.append(f"SUM({col} % 2147483647)")
+        select.append(f"SUM(({col} % 2147483647) * ({col} % 2147483647) % 2147483647)")
+    curs.execute(f"SELECT {list_to_string(select, 1)} FROM {db_name}.{table_name};")
+    temp = curs.fetchone()
+    aggregates = {"rows": temp[0]}
+    for i in range(0, len(columns)):
+        aggregates[columns[i]] = [temp[1 + 3*i], temp[2 + 3*i] or 0, temp[3 + 3*i] or 0]
+    return aggregates
+
+# 1.15 Add the aggregates of one table to a running total
+#
+# @param total the running total (a dict from get_table_aggregates), updated in place
+# @param aggregates the aggregates to add
+# @return the updated total
+
+def add_aggregates(total, aggregates):
+    for key in aggregates:
+        if key == "rows":
+            total["rows"] = total.get("rows", 0) + aggregates["rows"]
+        else:
+            current = total.get(key, [0, 0, 0])
+            total[key] = [current[i] + aggregates[key][i] for i in range(0, 3)]
+    return total
+
+# 1.16 Verify the merged tables against the aggregates recorded while reading the donors
+#
+# @param expected a dict {table_name: aggregates} of the expected merged output
+# @param id_columns the ID columns that were checksummed
+# @return a list of [table_name, expected, actual] for each table that does not match
+
+def verify_merge(expected, id_columns):
+    mismatches = []
+    for table_name in expected:
+        actual = get_table_aggregates(table_name, id_columns)
+        if actual != expected[table_name]:
+            mismatches.append([table_name, expected[table_name], actual])
+    return mismatches
+
+
+# 1.17 Get the measurement (feature) columns of a table
+#
+# @param table_name the name of the table (i.e. "Per_Object")
+# @param id_columns the ID columns to leave out
+# @return a string array of the REAL/FLOAT columns, without ID and object number columns
+
+def get_feature_columns(table_name, id_columns):
+    features = []
+    for col in get_column_names_types(table_name):
+        coltype = col[1].upper()
+        if (col[0] in id_columns or col[0].endswith("Number_Object_Number")):
+            continue
+        if ("REAL" in coltype or "FLOA" in coltype or "DOUB" in coltype):
+            features.append(col[0])
+    return features
+
+# 1.18 Combine two sets of per-feature summary statistics
+#
+# @param a, b dicts {"n": counts, "mean": means, "m2": sums of squared deviations, "sketch": quantile points}
+#        with one entry per feature (the sketch has sketch_size rows and one column per feature)
+# @param sketch_size the number of evenly spaced quantile points kept per feature
+# @return the combined dict, means and variances are combined exactly (Chan et al.), quantiles
+#         approximately by re-sampling the weighted union of both sketches at sketch_size ranks
+
+def merge_summaries(a, b, sketch_size):
+    n = a["n"] + b["n"]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.nan_to_num(b["mean"]) - np.nan_to_num(a["mean"])
+        mean = np.where(n > 0, np.nan_to_num(a["mean"]) + delta * b["n"] / n, np.nan)
+        m2 = np.where(n > 0, np.nan_to_num(a["m2"]) + np.nan_to_num(b["m2"]) + delta**2 * a["n"] * b["n"] / n, np.nan)
+    ranks = (np.arange(sketch_size) + 0.5) / sketch_size
+    sketch = np.full_like(a["sketch"], np.nan)
+    for f in range(0, len(n)):
+        if b["n"][f] == 0:
+            sketch[:, f] = a["sketch"][:, f]
+        elif a["n"][f] == 0:
+            sketch[:, f] = b["sketch"][:, f]
+        else:
+            values = np.concatenate([a["sketch"][:, f], b["sketch"][:, f]])
+            weights = np.concatenate([np.full(sketch_size, a["n"][f] / sketch_size),
+                                      np.full(sketch_size, b["n"][f] / sketch_size)])
+            order = np.argsort(values)
+            cumulative = np.cumsum(weights[order]) - weights[order] / 2
+            sketch[:, f] = np.interp(ranks * n[f], cumulative, values[order])
+    return {"n": n, "mean": mean, "m2": m2, "sketch": sketch}
+
+# 1.19 Summarize the objects of a set of rows
+#
+# @param values a 2d numpy array of feature values (rows are objects, columns are features)
+# @param sketch_size the number of evenly spaced quantile points to keep per feature
+# @return a summary dict as used by merge_summaries
+
+def summarize_values(values, sketch_size):
+    ranks = (np.arange(sketch_size) + 0.5) / sketch_size
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)  # all-NULL features give nan
+        n = np.sum(~np.isnan(values), axis=0).astype(float)
+        mean = np.nanmean(values, axis=0)
+        m2 = np.nanvar(values, axis=0) * n
+        sketch = np.nanquantile(values, ranks, axis=0)
+    return {"n": n, "mean": mean, "m2": m2, "sketch": sketch}
+
+# 1.20 Turn a summary into rows of count, mean, standard deviation and quantiles
+#
+# @param summary a summary dict as used by merge_summaries
+# @param quantiles the quantiles to report, i.e. [0.25, 0.5, 0.75]
+# @return a dict {"Count": array, "Mean": array, "StDev": array, "Quantile_50": array, ...}
+
+def finalize_summary(summary, quantiles):
+    sketch_size = summary["sketch"].shape[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stdev = np.where(summary["n"] > 1, np.sqrt(summary["m2"] / (summary["n"] - 1)), np.nan)
+    stats = {"Count": summary["n"], "Mean": summary["mean"], "StDev": stdev}
+    for q in quantiles:
+        pos = np.clip(q * sketch_size - 0.5, 0, sketch_size - 1)
+        lo = int(np.floor(pos))
+        hi = min(lo + 1, sketch_size - 1)
+        stats[f"Quantile_{int(round(q * 100))}"] = summary["sketch"][lo] * (1 - (pos - lo)) + summary["sketch"][hi] * (pos - lo)
+    return stats
+
+# 1.21 Summarize the objects of an attached database by image and add them to the running well summaries
+#
+# @param db_name the name of the (attached) database, i.e. "main" or "db_0_1"
+# @param features the feature columns to summarize
+# @param image_key the Per_Object column identifying an image (ImageNumber, or GroupNumber when grouping)
+# @param well_columns the Per_Image metadata columns identifying a well, i.e. plate and well
+# @param quantiles the quantiles to report
+# @param sketch_size the number of quantile points kept per feature and well
+# @param well_summaries a dict {(plate, well): summary} updated in place
+# @param join_key the column joining Per_Object to Per_Image (GroupNumber when Per_Image has one row per image, see 2.14)
+# @return none, per image summaries are appended to the Summary_Image_<statistic> tables in main
+
+def summarize_donor(db_name, features, image_key, well_columns, quantiles, sketch_size, well_summaries, join_key="ImageNumber"):
+    ## the donor's missing columns (see 1.38) are read as NULL
+    select = [f"o.{image_key}",
+              get_select_columns('Per_Image', well_columns, db_name, "i.")[0],
+              get_select_columns('Per_Object', features, db_name, "o.")[0]]
+    df = pd.read_sql_query(f"SELECT {list_to_string([col for col in select if col != ''], 1)} FROM {db_name}.Per_Object AS o "
+                           f"LEFT JOIN {db_name}.Per_Image AS i ON i.{join_key} = o.{join_key};", conn)
+    df[features] = df[features].apply(pd.to_numeric, errors='coerce')
+    ## per image summaries are exact, each image is complete within one donor
+    grouped = df.groupby(image_key)[features]
+    stats = {"Count": grouped.count(), "Mean": grouped.mean(), "StDev": grouped.std()}
+    for q in quantiles:
+        stats[f"Quantile_{int(round(q * 100))}"] = grouped.quantile(q)
+    for stat in stats:
+        stats[stat].reset_index().to_sql(f"Summary_Image_{stat}", conn, index = False, if_exists = 'append')
+    ## per well summaries are combined with what was seen in earlier donors
+    if len(well_columns) > 0:
+        for key, group in df.groupby(well_columns, dropna = False):
+            key = key if isinstance(key, tuple) else (key,)
+            key = tuple(None if pd.isna(k) else k for k in key) # the same keys as count_database reads
+            summary = summarize_values(group[features].to_numpy(dtype=float), sketch_size)
+            if key in well_summaries:
+                summary = merge_summaries(well_summaries[key], summary, sketch_size)
+            well_summaries[key] = summary
+    del df
+
+# 1.22 Write the running well summaries to the Summary_Well_<statistic> tables in main
+#
+# @param well_summaries a dict {(plate, well): summary}
+# @param features the feature columns that were summarized
+# @param well_columns the Per_Image metadata columns identifying a well
+# @param quantiles the quantiles to report
+# @return none, rows are appended so finished wells can be written while the merge is running (see 1.45)
+
+def write_well_summaries(well_summaries, features, well_columns, quantiles):
+    rows = {}
+    for key in well_summaries:
+        stats = finalize_summary(well_summaries[key], quantiles)
+        for stat in stats:
+            rows.setdefault(stat, []).append(list(key) + list(stats[stat]))
+    for stat in rows:
+        pd.DataFrame(rows[stat], columns = well_columns + features).to_sql(f"Summary_Well_{stat}", conn, index = False, if_exists = 'append')
+    conn.commit()
+
+# 1.23 Fingerprint a database from its Per_Image metadata/file name/path name columns and table row counts
+#
+# @param db_name the name of the database file (i.e. "example.db")
+# @param table_names the tables whose row counts are part of the fingerprint
+# @return [fingerprint, image_keys] where image_keys is a sorted list of hashes, one per distinct image
+# opens its own connection so it can run in a worker thread
+
+def fingerprint_database(db_name, table_names):
+    db_conn = sqlite3.connect(db_name, timeout = 10)
+    db_curs = db_conn.cursor()
+    db_curs.execute("PRAGMA table_info(Per_Image);")
+    columns = [row[1] for row in db_curs.fetchall()
+               if ("FileName" in row[1] or "PathName" in row[1] or "URL" in row[1] or "Metadata" in row[1])] # file names alone repeat across plates
+    images = []
+    if len(columns) > 0:
+        db_curs.execute(f"SELECT DISTINCT {list_to_string(columns, 1)} FROM Per_Image;")
+        images = sorted(set(hashlib.sha1(repr((columns, row)).encode()).hexdigest() for row in db_curs.fetchall()))
+    fingerprint = hashlib.sha1()
+    for image in images:
+        fingerprint.update(image.encode())
+    for table_name in table_names:
+        db_curs.execute(f"SELECT COUNT(*) FROM {table_name};")
+        fingerprint.update(f"{table_name}:{db_curs.fetchone()[0]}".encode())
+    db_curs.close()
+    db_conn.close()
+    return [fingerprint.hexdigest(), images]
+
+# 1.24 Find duplicate and overlapping databases
+#
+# @param db_names the databases, in merge order
+# @param fingerprints the [fingerprint, image_keys] of each database, from fingerprint_database
+# @return a list of [db_name, reason] for each database to drop, the first occurrence of an image is kept
+# databases without metadata or file name columns can't be identified and are never dropped
+
+def find_duplicate_databases(db_names, fingerprints):
+    seen_fingerprints = {}
+    seen_images = {}
+    duplicates = []
+    for i in range(0, len(db_names)):
+        fingerprint, images = fingerprints[i]
+        if len(images) == 0:
+            continue
+        if fingerprint in seen_fingerprints:
+            duplicates.append([db_names[i], f"Reason: Duplicate of {seen_fingerprints[fingerprint]}, database excluded from merge."])
+            continue
+        overlap = [seen_images[image] for image in images if image in seen_images]
+        if len(overlap) > 0:
+            duplicates.append([db_names[i], f"Reason: {len(overlap)} of {len(images)} images already in {overlap[0]}, database excluded from merge."])
+            continue
+        seen_fingerprints[fingerprint] = db_names[i]
+        for image in images:
+            seen_images[image] = db_names[i]
+    return duplicates
+
+# 1.25 Check that a database file is intact
+#
+# @param db_name the name of the database file (i.e. "example.db")
+# @param check "quick_check" or "integrity_check", the PRAGMA used to check the b-trees
+# @return None if the database is healthy, otherwise a string with the reason it is not
+# checks the file header and that the file size agrees with the page size and page count
+# before running the PRAGMA, opens its own read-only connection so it can run in a worker thread
+
+def check_database(db_name, check):
+    try:
+        size = os.path.getsize(db_name)
+        with open(db_name, 'rb') as dbFile:
+            header = dbFile.read(100)
+    except OSError as e:
+        return f"Reason: Could not read file ({e})."
+    if size == 0:
+        return "Reason: Empty file."
+    if len(header) < 100 or header[:16] != b"SQLite format 3\x00":
+        return "Reason: Not an SQLite database (bad header)."
+    page_size = int.from_bytes(header[16:18], 'big')
+    page_size = 65536 if page_size == 1 else page_size
+    if page_size < 512 or page_size > 65536 or (page_size & (page_size - 1)) != 0:
+        return f"Reason: Invalid page size {page_size} in header."
+    if not os.path.exists(db_name + "-wal"):
+        if size % page_size != 0:
+            return f"Reason: File size {size} is not a multiple of the page size {page_size} (truncated?)."
+        page_count = int.from_bytes(header[28:32], 'big')
+        if header[24:28] == header[92:96] and page_count * page_size != size:
+            return f"Reason: Header records {page_count} pages but the file holds {size // page_size} (truncated?)."
+    db_conn = None
+    try:
+        ## read-only, so a hot journal left by an interrupted job is reported instead of rolled back
+        db_conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(db_name))}?mode=ro", uri = True, timeout = 10)
+        result = db_conn.execute(f"PRAGMA {check};").fetchall()
+    except sqlite3.DatabaseError as e:
+        return f"Reason: {check} failed ({e})."
+    finally:
+        if db_conn is not None:
+            db_conn.close()
+    if result != [("ok",)]:
+        return f"Reason: {check} reported {len(result)} problem(s), first: {result[0][0]}"
+    return None
+
+# 1.26 Move a database (and any journal or WAL file next to it) into the quarantine directory
+#
+# @param db_name the name of the database file (i.e. "example.db")
+# @param reason the reason the database was quarantined, written to <name>.reason.txt
+# @param quarantine_dir the directory to move the database into
+# @return none
+
+def quarantine_database(db_name, reason, quarantine_dir):
+    os.makedirs(quarantine_dir, exist_ok = True)
+    for suffix in ["", "-journal", "-wal", "-shm"]:
+        if os.path.exists(db_name + suffix):
+            shutil.move(db_name + suffix, os.path.join(quarantine_dir, os.path.basename(db_name) + suffix))
+    with open(os.path.join(quarantine_dir, os.path.basename(db_name) + ".reason.txt"), 'w') as reasonFile:
+        reasonFile.write(f"{db_name}\n{reason}\n")
+
+
+# 1.27 Rebuild a table as a WITHOUT ROWID table clustered on its key columns
+#
+# @param table_name the name of the table (i.e. "Per_Object")
+# @param key_columns the columns of the clustered primary key (i.e. ["ImageNumber", "ObjectNumber"])
+# @return none
+# rows are stored in key order, so range scans on the key (i.e. all objects of an image) read contiguous pages
+
+def cluster_table(table_name, key_columns):
+    keys = list_to_string(key_columns, 1)
+    colnamtyp = list_to_string(get_column_names_types(table_name), 2) + f", PRIMARY KEY ({keys})"
+    colnam = list_to_string(get_column_names(table_name), 1)
+    curs.execute(f"CREATE TABLE _{table_name}({colnamtyp}) WITHOUT ROWID;")
+    curs.execute(f"INSERT INTO _{table_name}({colnam}) SELECT {colnam} FROM {table_name} ORDER BY {keys};")
+    curs.execute(f"DROP TABLE {table_name};")
+    curs.execute(f"ALTER TABLE _{table_name} RENAME TO {table_name};")
+    conn.commit()
+
+
+# 1.28 Create the Per_Object table of a database with SingleObjectView output
+#
+# @param db_name the name of the database file (i.e. "example.db")
+# @return none
+# makes a Per_Object table from the per object(n) tables using an inner join (see 4.2.1)
+
+def create_per_object(db_name):
+    global conn
+    global curs
+    conn = sqlite3.connect(db_name, timeout = 10)
+    curs = conn.cursor()
+    curs.execute("PRAGMA legacy_alter_table = TRUE;")
+### part 1 - rename ImangeNumber in the original per_object(n) tables
+    for f in range(0, len(objects)):
+        # get column names/types for object(n) table and rename ImageNumber column
+        ob = objects[f]
+        curs.execute(f"ALTER TABLE Per_{ob} RENAME COLUMN ImageNumber TO {ob}_ImageNumber")
+        # add img_no and obj_no cols to be renumbered later (CP requires UNIQUE img and obj number columns in the final aggregated tables)
+        curs.execute(f"ALTER TABLE Per_{ob} ADD {ob}_img_no integer;")
+        curs.execute(f"ALTER TABLE Per_{ob} ADD {ob}_obj_no integer;")
+        curs.execute(f"UPDATE Per_{ob} SET {ob}_obj_no = {ob}_Number_Object_Number")
+        conn.commit()
+### Add corresponding img_no column in Per_Image
+    curs.execute("ALTER TABLE Per_Image ADD img_no integer;")
+### part 2 - make the per-object table
+    # Drop per_object views if exists
+    curs.execute("SELECT name FROM sqlite_master WHERE type = 'view';")
+    views = curs.fetchall()
+    for x in range(0, len(views)):
+        curs.execute(f"DROP VIEW IF EXISTS {views[x][0]}")
+    conn.commit()
+    # produce list of column names and types from each per_object(n) table to make the Per_Object table (and adds objectnumber column)
+    colnamtyps = []
+    for f in range(0, len(objects)):
+        ob = objects[f]
+        c = get_column_names_types(f"Per_{ob}")
+        colnamtyps = colnamtyps + c
+    colnamtyps.insert(1, ['obj_no', "INTEGER"]) #insert ObjectNumber column at 2nd positon
+    colnamtyps_PO = list_to_string(colnamtyps, 2)
+    # Creates Per_Object Table
+    curs.execute(f"CREATE TABLE Per_Object({colnamtyps_PO})")
+    conn.commit()
+### Part 3 - put data in the Per_Object Table
+    # get column names for Per_Obj statement
+    colnams_po = list_to_string(get_column_names('Per_Object'), 1)
+    # get column names for select statment
+    colnams_sel = []
+    for e in range(0, len(objects)):
+        ob = objects[e]
+        c = get_column_names(f"Per_{ob}")
+        colnams_sel = colnams_sel + c
+    colnams_sel.insert(1, f"{object1}_Number_Object_Number") #to insert data from primaryobj_Number_Object_Number into the column ObjectNumber
+    colnams_sel = list_to_string(colnams_sel, 1)
+    # insert data (comment in/out left or inner join)
+    #LeftJoin = f"INSERT INTO Per_Object({colnams_po}) SELECT {colnams_sel} FROM Per_{object1} LEFT JOIN Per_{object2} ON Per_{object1}.{object1}_ImageNumber = Per_{object2}.{object2}_ImageNumber AND Per_{object1}.{object1}_Number_Object_Number = Per_{object2}.{object2}_Parent_{object1} LEFT JOIN Per_{object3} ON Per_{object1}.{object1}_ImageNumber = Per_{object3}.{object3}_ImageNumber AND Per_{object1}.{object1}_Number_Object_Number = Per_{object3}.{object3}_Parent_{object1};"
+    InnerJoin = f"INSERT INTO Per_Object({colnams_po}) SELECT {colnams_sel} FROM Per_{object1} INNER JOIN Per_{object2} ON Per_{object1}.{object1}_ImageNumber = Per_{object2}.{object2}_ImageNumber AND Per_{object1}.{object1}_Number_Object_Number = Per_{object2}.{object2}_Parent_{object1} INNER JOIN Per_{object3} ON Per_{object1}.{object1}_ImageNumber = Per_{object3}.{object3}_ImageNumber AND Per_{object1}.{object1}_Number_Object_Number = Per_{object3}.{object3}_Parent_{object1};"
+    curs.execute(InnerJoin)
+    conn.commit()
+    # remove excess image number columns
+    for d in range(1, len(objects)):
+        ob = objects[d]
+        curs.execute(f"ALTER TABLE Per_Object DROP COLUMN {ob}_ImageNumber;")
+        conn.commit()
+    curs.execute(f"ALTER TABLE Per_Object RENAME COLUMN {object1}_ImageNumber TO img_no;")
+    # remove excess columns
+    for v in range(0, len(objects)):
+        ob = objects[v]
+        curs.execute(f"ALTER TABLE Per_Object DROP COLUMN {ob}_img_no;")
+    close_connection()
+
+# 1.29 Count the objects in a database
+#
+# @param db_name the name of the database file (i.e. "example.db")
+# @return [number of objects, number of ObjectNumbers that are a multiple of 200, [object1 count, object2 count, object3 count],
+#          [objects before subsampling, objects kept], the distinct summary_well_columns values of Per_Image (see 2.7)]
+# these counts are all that is needed to work out where the numbering of every following database starts (see 4.2.2),
+# creates the Per_Object table first for SingleObjectView output and subsamples the objects first if set in 2.13
+
+def count_database(db_name):
+    global conn
+    global curs
+    if (db_type == 'SingleObjectView'):
+        create_per_object(db_name)
+    conn = sqlite3.connect(db_name, timeout = 10)
+    curs = conn.cursor()
+    sampled = None
+    if (subsample_fraction is not None or subsample_count is not None):
+        sampled = subsample_database(db_name, subsample_fraction, subsample_count, subsample_by, subsample_seed)
+    tables = get_table_names()
+    curs.execute(f"SELECT COUNT ({obj_no}), TOTAL({obj_no} % 200 = 0) FROM Per_Object;")
+    chk = curs.fetchone()
+    object_counts = []
+    for f in range(0, len(objects)):
+        ob = objects[f]
+        table = f"Per_{ob}" if f"Per_{ob}" in tables else "Per_Object"
+        curs.execute(f"SELECT COUNT ({ob}_{no_obj_no}) FROM {table};")
+        object_counts.append(int(curs.fetchone()[0]))
+    wells = []
+    if (build_summaries and len(summary_well_columns) > 0):
+        image_columns = get_column_names('Per_Image')
+        curs.execute(f"SELECT DISTINCT {list_to_string([col if col in image_columns else 'NULL' for col in summary_well_columns], 1)} FROM Per_Image;")
+        wells = curs.fetchall()
+    close_connection()
+    return [int(chk[0]), int(chk[1]), object_counts, sampled, wells]
+
+# 1.30 Pre-process a database for the merge: ImageNumber grouping, removing column constraints and renumbering
+#
+# @param db_name the name of the database file (i.e. "example.db")
+# @param offsets {"img": ImageNumber, "grp": first group number, "obj": [object1, object2, object3 offsets]}
+#        for this database, from the counts of the databases before it (see 4.2.2)
+# @param do_grouping whether objects are grouped into blocks of 200 per ImageNumber
+# @return [db_name, None] on success or [db_name, traceback] if pre-processing failed
+# only touches db_name, so databases can be pre-processed in any order or in parallel
+
+def preprocess_database(db_name, offsets, do_grouping):
+    global conn
+    global curs
+    conn = sqlite3.connect(db_name, timeout = 10)
+    curs = conn.cursor()
+    try:
+        if (do_grouping):
+            grpit = offsets["grp"]
+        ## Get and sort tables from DB
+            listTable = get_table_names()
+            listTable.sort()
+        ## Communicate step
+            print(f"Adding GroupNumber to {db_name}: Per_Object Table.")
+###### ObjectNumber table #######
+        ## Get ObjectNumber count from Per_Object table and initialize variables
+          ## Get the ObjectNumber column from Per_Object
+            curs.execute(f"SELECT {obj_no} FROM Per_Object;")
+            objno = curs.fetchall()
+          ## Set variables for lists
+            grp_id = []
+            obj_id = fetch_to_list(objno)
+        ## Create two lists, one that corresponds to entries in the ObjectNumber column
+        ## and one that produces a group_id for each 1000 entries in the ObjectNumber column
+            for x in obj_id:
+                grp_id.append(grpit) #create a list of group_ids that increments per 200 ObjectNumbers
+                if (x % 200 == 0):
+                    grpit += 1
+                else:
+                    continue
+        ## Create a dataframe from the lists
+            data = {f'Object_no':obj_id, 'GroupNumber':grp_id}
+            df = pd.DataFrame(data)
+        ## Send the dataframe to sqlite3 grpnum table and remove objects from env
+            df.to_sql('grpnum', conn, schema='main', index = False, chunksize = 1000, method = 'multi')
+            del data
+            del df
+            conn.commit()
+        ## Initialize column designations for grouping statement
+            colnamtyp = list_to_string(get_column_names_types('Per_Object'), 2)
+            colnamtyp = "GroupNumber INTEGER, " + colnamtyp
+            colnam = list_to_string(get_column_names('Per_Object'), 1)
+            colnam = "GroupNumber, " + colnam
+        ## Create a join statement and create a joined table
+            SelectJoin = f"SELECT {colnam} FROM Per_Object INNER JOIN grpnum ON grpnum.Object_no = Per_Object.{obj_no}"
+            curs.execute(f"CREATE TABLE Joiner({colnamtyp});")
+            curs.execute(f"INSERT INTO Joiner({colnam}) {SelectJoin};")
+            conn.commit()
+        ## Remove the old Grouping and Per_Object tables and rename Joiner to Per_Object
+            curs.execute("DROP TABLE IF EXISTS grpnum;")
+            curs.execute("DROP TABLE IF EXISTS Per_Object;")
+            curs.execute("ALTER TABLE Joiner RENAME TO Per_Object;")
+            print(f"Objects are now grouped into blocks of 200 by ImageNumber in {db_name}.Per_Object... Use GroupNumber to filter by Image")
+            conn.commit()
+###### ImageNumber table #######
+         ## With group_image_mapping (2.14) each image is stored once, keyed by GroupNumber, and Per_Image_Groups maps
+         ## every GroupNumber block (the ImageNumber CPA sees) to its image (see 5.5)
+            if (group_image_mapping):
+                curs.execute("CREATE TABLE Per_Image_Groups(ImageNumber INTEGER, GroupNumber INTEGER);")
+                curs.execute(f"INSERT INTO Per_Image_Groups(ImageNumber, GroupNumber) SELECT DISTINCT GroupNumber, {img_no} FROM Per_Object ORDER BY GroupNumber;")
+                swap_column_names("Per_Object", "GroupNumber", f"{img_no}")
+                rename_column("Per_Image", f"{img_no}", "GroupNumber")
+                print(f"{db_name}.Per_Image_Groups now maps the GroupNumber blocks in Per_Object to the images in Per_Image... Use GroupNumber to filter by Image")
+                conn.commit()
+            else:
+             ## Get table info
+             ## In this case, don't use column types for joiner to avoid ImageNumber Unique constraint
+                colnam = list_to_string(get_column_names('Per_Image'), 1)
+                colnam = "GroupNumber, " + colnam
+             ## Create a grouping table
+                curs.execute(f"CREATE TABLE grpnum(GroupNumber INTEGER, {img_no} INTEGER);")
+                curs.execute(f"INSERT INTO grpnum(GroupNumber, {img_no}) SELECT DISTINCT GroupNumber, {img_no} FROM Per_Object ORDER BY GroupNumber;")
+             ## Create a pandas dataframe to re-create the Per_Image table including the revised group numbering
+                grpnum = pd.read_sql_query("SELECT * FROM grpnum;", conn)
+                perimg = pd.read_sql_query("SELECT * FROM Per_Image;", conn)
+                for (columnName, columnData) in perimg.items():
+                    if (f"{columnName}" == f'{img_no}' or f"{columnName}" == 'GroupNumber'):
+                        continue
+                    else:
+                        grpnum[f'{columnName}'] = columnData[0]
+            ## Send the new perimg dataframe to sqlite
+                grpnum.to_sql('perimg', conn, schema='main', index = False, chunksize = 1000, method = 'multi')
+                del perimg
+                del grpnum
+                conn.commit()
+             ## Create a the new Per_Image_ table and insert the dataframe records
+                curs.execute(f"CREATE TABLE Per_Image_({colnam});")
+                curs.execute(f"INSERT INTO Per_Image_({colnam}) SELECT {colnam} FROM perimg;")
+                conn.commit()
+             ## Renaming Columns for Both Tables
+                swap_column_names("Per_Image_", "GroupNumber", f"{img_no}")
+                swap_column_names("Per_Object", "GroupNumber", f"{img_no}")
+                conn.commit()
+             ## Get rid of old tables
+                curs.execute("DROP TABLE IF EXISTS grpnum;")
+                curs.execute("DROP TABLE IF EXISTS perimg;")
+                curs.execute("DROP TABLE IF EXISTS Per_Image;")
+                curs.execute("ALTER TABLE Per_Image_ RENAME TO Per_Image;")
+                print(f"{db_name}.Per_Image ImageNumbers have now been updated to reflect the ImageNumber grouping in Per_Object... Use GroupNumber to filter by Image")
+                conn.commit()
+    ### get db info
+        listTable = get_table_names()
+        listTable.sort()
+        print(f"Renumbering objects in {db_name}.")
+    ### sorts listTable so that Per_Object table is last and renumbering happens correctly
+        listTable.append(listTable.pop(listTable.index('Per_Object')))
+    ### set the numbering offsets for this database
+        img = offsets["img"]
+        obj_1_temp = offsets["obj"][0]
+        obj_2_temp = offsets["obj"][1]
+        obj_3_temp = offsets["obj"][2]
+    ###
+    ### remove column constraints (each table from each database)
+        for g in range(0, len(listTable)):
+            colnamtyp = list_to_string(get_column_names_types(listTable[g]), 2)
+            colnam = list_to_string(get_column_names(listTable[g]), 1)
+            curs.execute("PRAGMA legacy_alter_table = TRUE;")
+            curs.execute(f"CREATE TABLE _{listTable[g]}({colnamtyp});")
+            curs.execute(f"INSERT INTO _{listTable[g]}({colnam}) SELECT {colnam} FROM {listTable[g]};")
+            curs.execute(f"DROP TABLE {listTable[g]};")
+            curs.execute(f"ALTER TABLE _{listTable[g]} RENAME TO {listTable[g]};")
+            conn.commit()
+    #######
+    ####### Per_Image ImageNumber renumbering statements
+            if (f"{listTable[g]}" == "Per_Image"):
+                if (do_grouping):
+                    curs.execute(f"UPDATE {listTable[g]} SET GroupNumber = {img};")
+                else:
+                    curs.execute(f"UPDATE {listTable[g]} SET {img_no} = {img};")
+                if (db_type == 'SingleObjectView'):
+                    curs.execute(f"ALTER TABLE {listTable[g]} DROP COLUMN IF EXISTS ImageNumber;")
+                print(f"Runumbering {img_no} in {db_name}: Per_Image table")
+                conn.commit()
+    #######
+    ####### Per_Image_Groups GroupNumber renumbering statement (ImageNumber already follows the GroupNumber offset)
+            elif (f"{listTable[g]}" == "Per_Image_Groups"):
+                curs.execute(f"UPDATE {listTable[g]} SET GroupNumber = {img};")
+                conn.commit()
+    #######
+    ####### Per_Object(n) Table ImageNumber and ObjectNumber renumbering statements for SingleObjectView
+            elif (f"{listTable[g]}" in [f'Per_{object1}', f'Per_{object2}', f'Per_{object3}']):
+                ob = listTable[g][len("Per_"):]
+                offset = [obj_1_temp, obj_2_temp, obj_3_temp][[object1, object2, object3].index(ob)]
+                curs.execute(f"UPDATE {listTable[g]} SET {ob}_{img_no} = {img};")
+                curs.execute(f"UPDATE {listTable[g]} SET {ob}_{no_obj_no} = {ob}_{no_obj_no} + {offset};")
+                print(f"Runumbering ImageNumber and ObjectNumber columns in {db_name}: Per_{ob} table")
+                conn.commit()
+    #######
+    ####### Per_Object Table ImageNumber and ObjectNumber renumbering statements
+            elif (f"{listTable[g]}" == 'Per_Object'):
+                print(f"Runumbering ImageNumber and ObjectNumber columns in {db_name}: {listTable[g]} table")
+    ###########
+    ########### Renumber ImageNumber Column
+                if (do_grouping):
+                    curs.execute(f"UPDATE {listTable[g]} SET GroupNumber = {img};")
+                else:
+                    curs.execute(f"UPDATE {listTable[g]} SET {img_no} = {img};")
+    ###########
+    ########### NB. CONDITIONAL UPDATE SYNTAX Table_Name SET Column = CASE WHEN (Column IS NULL) THEN (Column) ELSE (Column + MATH) END;
+    ########### Renumber ObjectNumber the same way as object1, conditional for non-null values
+                curs.execute(f"UPDATE {listTable[g]} SET {obj_no} = CASE WHEN ({obj_no} IS NULL) THEN ({obj_no}) ELSE ({obj_no} + {obj_1_temp}) END;")
+    ###########
+    ########### Renumber object1 if not null (left join may produce null values)
+                curs.execute(f"UPDATE {listTable[g]} SET {object1}_{no_obj_no} = CASE WHEN ({object1}_{no_obj_no} IS NULL) THEN ({object1}_{no_obj_no}) ELSE ({object1}_{no_obj_no} + {obj_1_temp}) END;")
+    ###########
+    ########### Renumber object2 if not null (left join may produce null values)
+                curs.execute(f"UPDATE {listTable[g]} SET {object2}_{no_obj_no} = CASE WHEN ({object2}_{no_obj_no} IS NULL) THEN ({object2}_{no_obj_no}) ELSE ({object2}_{no_obj_no} + {obj_2_temp}) END;")
+    ###########
+    ########### Renumber object3 if not null (left join may produce null values)
+                curs.execute(f"UPDATE {listTable[g]} SET {object3}_{no_obj_no} = CASE WHEN ({object3}_{no_obj_no} IS NULL) THEN ({object3}_{no_obj_no}) ELSE ({object3}_{no_obj_no} + {obj_3_temp}) END;")
+    ###########
+    ########### Commit Changes
+                conn.commit()
+            else:
+                continue
+    ############
+    ############ Rename img_no and obj_no columns in Per_Object table created from SingleObjectView output
+        if (db_type == 'SingleObjectView'):
+            curs.execute("ALTER TABLE Per_Image RENAME COLUMN {img_no} TO ImageNumber;")
+            curs.execute("ALTER TABLE Per_Image RENAME COLUMN {obj_no} TO ObjectNumber;")
+            curs.execute("ALTER TABLE Per_Object RENAME COLUMN {img_no} TO ImageNumber;")
+            curs.execute("ALTER TABLE Per_Image RENAME COLUMN {obj_no} TO ObjectNumber;")
+            conn.commit()
+        close_connection()
+        return [db_name, None]
+    except Exception:
+        conn.close()
+        return [db_name, traceback.format_exc()]
+
+# 1.31 Run a function over a list of databases in worker processes
+#
+# @param function the function to run, called as function(db_name)
+# @param db_names the databases
+# @param workers the number of worker processes
+# @return a list of the function's results, in the order of db_names
+# worker processes are forked, so they see the settings of this script without re-running it,
+# where fork is not available (Windows) or not safe (macOS lists it, but forked processes can crash there)
+# the databases are processed one at a time
+
+def map_databases(function, db_names, workers):
+    if (workers < 2 or sys.platform == 'darwin' or 'fork' not in multiprocessing.get_all_start_methods()):
+        return [function(db_name) for db_name in db_names]
+    with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('fork')) as pool:
+        return list(pool.map(function, db_names))
+
+# 1.32 Pre-process databases in worker processes while the caller merges the ones that are ready
+#
+# @param db_names the databases, in merge order
+# @param offsets the numbering offsets of each database (see preprocess_database)
+# @param do_grouping whether objects are grouped into blocks of 200 per ImageNumber
+# @param workers the number of worker processes
+# @param depth the largest number of databases pre-processed ahead of the merge
+# @return a generator of [db_name, error] from preprocess_database, in the order of db_names
+# at most depth databases are pre-processed but not yet merged, which bounds the extra disk space they use.
+# where fork is not available or not safe (Windows, macOS) every database is pre-processed before the first one is returned,
+# because the worker would otherwise share this script's connection to mainDB
+
+def preprocess_pipeline(db_names, offsets, do_grouping, workers, depth):
+    if (depth < 1 or sys.platform == 'darwin' or 'fork' not in multiprocessing.get_all_start_methods()):
+        results = [preprocess_database(db_names[h], offsets[h], do_grouping) for h in range(0, len(db_names))]
+        for result in results:
+            yield result
+        return
+    with ProcessPoolExecutor(max_workers = max(workers, 1), mp_context = multiprocessing.get_context('fork')) as pool:
+        pending = deque()
+        for h in range(0, len(db_names)):
+            pending.append(pool.submit(preprocess_database, db_names[h], offsets[h], do_grouping))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+# 1.33 Pack the feature columns of Per_Object into one float32 vector per object
+#
+# @param db_name the name of the (attached) database, i.e. "main" or "db_0_1"
+# @param features the feature columns to pack, in the order listed in Per_Object_Packed_Columns
+# @return none, rows are appended to Per_Object_Packed(ImageNumber, ObjectNumber, Features) in main
+# each vector is stored as little-endian float32 (numpy dtype '<f4'), NULL values are stored as NaN,
+# as are the features a donor lacks (see 1.38)
+
+def pack_donor(db_name, features):
+    select_columns = get_select_columns('Per_Object', ['ImageNumber', 'ObjectNumber'] + features, db_name)[0]
+    df = pd.read_sql_query(f"SELECT {select_columns} FROM {db_name}.Per_Object;", conn)
+    vectors = df[features].apply(pd.to_numeric, errors='coerce').to_numpy(dtype='<f4')
+    rows = zip(df["ImageNumber"].tolist(), df["ObjectNumber"].tolist(), [vector.tobytes() for vector in vectors])
+    curs.executemany("INSERT INTO Per_Object_Packed(ImageNumber, ObjectNumber, Features) VALUES (?, ?, ?);", rows)
+    del df
+    del vectors
+
+# 1.34 Rebuild a table keeping only some of its columns
+#
+# @param table_name the name of the table (i.e. "Per_Object")
+# @param columns the columns to keep, in their current order
+# @return none
+
+def keep_columns(table_name, columns):
+    colnamtyp = [col for col in get_column_names_types(table_name) if col[0] in columns]
+    colnam = list_to_string([col[0] for col in colnamtyp], 1)
+    curs.execute(f"CREATE TABLE _{table_name}({list_to_string(colnamtyp, 2)});")
+    curs.execute(f"INSERT INTO _{table_name}({colnam}) SELECT {colnam} FROM {table_name};")
+    curs.execute(f"DROP TABLE {table_name};")
+    curs.execute(f"ALTER TABLE _{table_name} RENAME TO {table_name};")
+    conn.commit()
+
+# 1.35 Keep a seeded random sample of the objects of a database and renumber them contiguously
+#
+# @param db_name the name of the database file (i.e. "example.db"), connected as main
+# @param fraction the fraction of objects to keep from each stratum (at least one object), or None
+# @param count the number of objects to keep from each stratum, or None (used if fraction is None)
+# @param by 'image' (one stratum per ImageNumber) or 'group' (one stratum per block of 200 ObjectNumbers of an image, see 4.2.1)
+# @param seed the random seed, the same seed keeps the same objects of the same database file
+# @return [objects before, objects kept]
+# ObjectNumber and the Number_Object_Number columns are renumbered 1..n in their original order so that
+# the offsets (see 4.2.1) keep the merged ObjectNumbers contiguous and unique
+
+def subsample_database(db_name, fraction, count, by, seed):
+    curs.execute(f"SELECT COALESCE({img_no}, 0), {obj_no} FROM Per_Object WHERE {obj_no} IS NOT NULL ORDER BY 1, 2;")
+    obj_id = curs.fetchall()
+    strata = {}
+    for (i, x) in obj_id:
+        strata.setdefault((i,) if by == 'image' else (i, (x - 1) // 200), []).append(x)
+    rng = np.random.default_rng([seed, int(hashlib.md5(os.path.basename(db_name).encode()).hexdigest()[:8], 16)])
+    keep = []
+    for key in sorted(strata):
+        n = len(strata[key])
+        k = min(n, max(1, int(round(fraction * n))) if fraction is not None else count) # small strata keep at least one object
+        keep.extend([(key[0], int(x)) for x in rng.choice(strata[key], size = k, replace = False).tolist()])
+    curs.execute("CREATE TEMP TABLE keep(img INTEGER, obj INTEGER, PRIMARY KEY(img, obj));")
+    curs.executemany("INSERT INTO temp.keep(img, obj) VALUES (?, ?);", keep)
+    curs.execute(f"DELETE FROM Per_Object WHERE {obj_no} IS NULL OR NOT EXISTS "
+                 f"(SELECT 1 FROM temp.keep WHERE img = COALESCE(Per_Object.{img_no}, 0) AND obj = Per_Object.{obj_no});")
+    tables = get_table_names()
+    columns = [obj_no] + [f"{ob}_{no_obj_no}" for ob in objects]
+    for col in dict.fromkeys(columns):
+    ### map the kept numbers of each column onto 1..n, in order
+        curs.execute("CREATE TEMP TABLE renumber(old INTEGER PRIMARY KEY, new INTEGER);")
+        curs.execute(f"INSERT INTO temp.renumber(old, new) SELECT {col}, ROW_NUMBER() OVER (ORDER BY {col}) FROM (SELECT DISTINCT {col} FROM Per_Object WHERE {col} IS NOT NULL);")
+        ob = col[:-len(f"_{no_obj_no}")] if col != obj_no else None
+        for table in ["Per_Object"] + ([f"Per_{ob}"] if f"Per_{ob}" in tables else []):
+            if (table != "Per_Object"):
+                curs.execute(f"DELETE FROM {table} WHERE {col} NOT IN (SELECT old FROM temp.renumber);")
+            curs.execute(f"UPDATE {table} SET {col} = (SELECT new FROM temp.renumber WHERE old = {col}) WHERE {col} IS NOT NULL;")
+        curs.execute("DROP TABLE temp.renumber;")
+    curs.execute("DROP TABLE temp.keep;")
+    conn.commit()
+    return [len(obj_id), len(keep)]
+
+# 1.36 Add the columns of a donor table to the union schema
+#
+# @param schema the union schema so far, {table name: [[colname1, coltype1], ...]}
+# @param table_name the name of the table (i.e. "Per_Object")
+# @param column_types the donor's columns and types, from get_column_names_types
+# @return none, columns not seen before are appended in the donor's order with the donor's type
+
+def add_to_schema(schema, table_name, column_types):
+    columns = schema.setdefault(table_name, [])
+    seen = set([col[0] for col in columns])
+    for col in column_types:
+        if col[0] not in seen:
+            columns.append(list(col))
+            seen.add(col[0])
+
+# 1.37 Add the columns of the union schema that a table in main is missing
+#
+# @param table_name the name of the table (i.e. "Per_Object")
+# @param column_types the union columns and types of the table
+# @return a string array of the columns added, which are NULL for the rows already in the table
+
+def reconcile_table(table_name, column_types):
+    existing = set(get_column_names(table_name))
+    added = []
+    for col in column_types:
+        if col[0] not in existing:
+            curs.execute(f"ALTER TABLE {table_name} ADD COLUMN {col[0]} {col[1]};")
+            added.append(col[0])
+    conn.commit()
+    return added
+
+# 1.38 Select the columns of a table in main from an attached donor, using NULL for the columns the donor lacks
+#
+# @param table_name the name of the table (i.e. "Per_Object")
+# @param column_names the columns of the table in main
+# @param db_name the name of the attached database (i.e. "db_0_1")
+# @param prefix the table alias the columns are selected from in a join (i.e. "o."), none by default
+# @return [select expressions, in the order of column_names, string array of the columns the donor lacks]
+
+def get_select_columns(table_name, column_names, db_name, prefix=""):
+    curs.execute(f"PRAGMA {db_name}.table_info({table_name});")
+    donor_columns = set([row[1] for row in curs.fetchall()])
+    select_names = [f"{prefix}{col}" if col in donor_columns else f"NULL AS {col}" for col in column_names]
+    missing = [col for col in column_names if col not in donor_columns]
+    return [list_to_string(select_names, 1), missing]
+
+# 1.39 Replace the grouped Per_Image table with a view over Per_Image_Data and Per_Image_Groups
+#
+# @return none
+# Per_Image holds one row per image, keyed by GroupNumber (see 2.14). it is renamed to Per_Image_Data and
+# the view Per_Image presents one row per GroupNumber block with ImageNumber first, as CPA expects
+
+def create_image_view():
+    curs.execute("ALTER TABLE Per_Image RENAME TO Per_Image_Data;")
+    columns = [f"d.{col}" for col in get_column_names('Per_Image_Data')]
+    curs.execute(f"CREATE VIEW Per_Image AS SELECT g.ImageNumber, {list_to_string(columns, 1)} FROM Per_Image_Groups AS g "
+                 f"JOIN Per_Image_Data AS d ON d.GroupNumber = g.GroupNumber;")
+    conn.commit()
+
+# 1.40 Set the storage pragmas of the current connection
+#
+# @param pragmas {pragma: value}, i.e. {"page_size": 65536, "mmap_size": 268435456, "cache_size": -262144,
+#        "temp_store": 2, "journal_mode": "WAL"}
+# @param page_size whether to change the page size of main too, which rewrites the database with VACUUM
+# @return none
+# only main is changed, attached donors keep their own settings
+
+def set_storage_pragmas(pragmas, page_size=False):
+    if (page_size and "page_size" in pragmas):
+        curs.execute("PRAGMA main.page_size;")
+        if (curs.fetchone()[0] != pragmas["page_size"]):
+            curs.execute("PRAGMA main.journal_mode = DELETE;") # the page size of a WAL database can not change
+            curs.execute(f"PRAGMA main.page_size = {pragmas['page_size']};")
+            curs.execute("VACUUM;")
+    for key in pragmas:
+        if (key == "page_size"):
+            continue
+        schema = "" if key == "temp_store" else "main."
+        curs.execute(f"PRAGMA {schema}{key} = {pragmas[key]};")
+        curs.fetchall()
+
+# 1.41 Time a merge of some databases into a new database under a set of storage pragmas
+#
+# @param db_names the databases to merge, attached read-only so they are not changed
+# @param table_names the tables to merge
+# @param out_name the database file to merge into, on the same volume as mainDB, deleted afterwards
+# @param pragmas the storage pragmas to use (see set_storage_pragmas)
+# @param merge_order {table name: key columns} of the tables that are clustered and merged in key order (see 5.1)
+# @return the seconds taken, or None if the merge failed or the result did not pass PRAGMA quick_check
+#         and match the row counts of the databases
+# the merge takes the same path as section 5: merge_table with the same ORDER BY into the same clustered tables,
+# then the pack, summary and spatial index steps that are turned on. ImageNumber and ObjectNumber of each
+# database are shifted past the databases before it, as pre-processing does, so the clustered keys stay unique
+
+def calibrate_pragmas(db_names, table_names, out_name, pragmas, merge_order):
+    global conn
+    global curs
+    for suffix in ["", "-journal", "-wal", "-shm"]:
+        if os.path.exists(out_name + suffix):
+            os.remove(out_name + suffix)
+    conn = sqlite3.connect(out_name, timeout = 10, uri = True)
+    curs = conn.cursor()
+    elapsed = None
+    try:
+        set_storage_pragmas(pragmas, True)
+        ## create the tables from the first database and find the key offsets, before the timer starts
+        key_offsets = []
+        next_offsets = {"ImageNumber": 0, "ObjectNumber": 0}
+        for k in range(0, len(db_names)):
+            curs.execute(f"ATTACH DATABASE 'file:{pathname2url(os.path.abspath(db_names[k]))}?mode=ro' AS src;")
+            key_offsets.append(dict(next_offsets))
+            for table in table_names:
+                curs.execute(f"PRAGMA src.table_info({table});")
+                column_types = [[row[1], row[2]] for row in curs.fetchall()]
+                if (k == 0):
+                    curs.execute(f"CREATE TABLE {table}({list_to_string(column_types, 2)});")
+                    if (table in merge_order):
+                        cluster_table(table, [col.strip() for col in merge_order[table].split(",")])
+                for col in [col[0] for col in column_types if col[0] in next_offsets]:
+                    curs.execute(f"SELECT MAX({col}) FROM src.{table};")
+                    next_offsets[col] = max(next_offsets[col], key_offsets[k][col] + (curs.fetchone()[0] or 0))
+            curs.execute("DETACH DATABASE src;")
+        steps = 'Per_Object' in table_names
+        features = get_feature_columns('Per_Object', id_columns) if steps else []
+        if (pack_features and steps):
+            curs.execute("CREATE TABLE Per_Object_Packed(ImageNumber INTEGER, ObjectNumber INTEGER, Features BLOB);")
+        well_columns = [col for col in summary_well_columns if col in get_column_names('Per_Image')]
+        spatial_columns = get_spatial_columns('Per_Object') if (build_spatial_index and steps) else []
+        try:
+            for [ob, min_x, max_x, min_y, max_y] in spatial_columns:
+                curs.execute(f"CREATE VIRTUAL TABLE Per_Object_RTree_{ob} USING rtree(id, minImageNumber, maxImageNumber, minX, maxX, minY, maxY);")
+        except sqlite3.OperationalError as e:
+            if "no such module" not in str(e):
+                raise
+            spatial_columns = []
+        conn.commit()
+        expected = dict([(table, 0) for table in table_names])
+        startCalibration = time.time()
+        for k in range(0, len(db_names)):
+            curs.execute(f"ATTACH DATABASE 'file:{pathname2url(os.path.abspath(db_names[k]))}?mode=ro' AS src;")
+            for table in table_names:
+                column_names = get_column_names(table)
+                missing = get_select_columns(table, column_names, "src")[1]
+                select_names = [f"NULL AS {col}" if col in missing else
+                                (f"{col} + {key_offsets[k][col]} AS {col}" if col in key_offsets[k] else col) for col in column_names]
+                if not merge_table(table, list_to_string(column_names, 1), "src", merge_order.get(table), list_to_string(select_names, 1)):
+                    raise sqlite3.DatabaseError(f"{db_names[k]}.{table} did not merge")
+                curs.execute(f"SELECT COUNT(*) FROM src.{table};")
+                expected[table] += curs.fetchone()[0]
+            if (pack_features and steps):
+                pack_donor("src", features)
+            if (build_summaries and steps):
+                summarize_donor("src", features, "ImageNumber", well_columns, summary_quantiles, summary_sketch_size, {})
+            conn.commit()
+            curs.execute("DETACH DATABASE src;")
+        if len(spatial_columns) > 0:
+            if not index_donor("main", spatial_columns, "ImageNumber"): # the shifted ObjectNumbers are unique R*Tree ids
+                raise sqlite3.DatabaseError("the spatial index could not be built")
+        conn.commit()
+        elapsed = time.time() - startCalibration
+        curs.execute("PRAGMA quick_check;")
+        if (curs.fetchone()[0] != "ok"):
+            elapsed = None
+        for table in table_names:
+            curs.execute(f"SELECT COUNT(*) FROM {table};")
+            if (curs.fetchone()[0] != expected[table]):
+                elapsed = None
+    except Exception:
+        traceback.print_exc()
+        elapsed = None
+    conn.close()
+    for suffix in ["", "-journal", "-wal", "-shm"]:
+        if os.path.exists(out_name + suffix):
+            os.remove(out_name + suffix)
+    return elapsed
+
+# 1.42 Find the fastest storage pragmas for the merge on this volume
+#
+# @param db_names a sample of the databases to merge
+# @param table_names the tables to merge
+# @param out_name the database file used for the calibration merges (see calibrate_pragmas)
+# @param candidates {pragma: [default value, other values...]}
+# @param repeats the number of times each profile is timed, the median time counts
+# @param margin the fraction a profile has to be faster than the best so far to replace it (i.e. 0.05)
+# @param merge_order {table name: key columns} of the tables merged in key order (see calibrate_pragmas)
+# @return [fastest profile, its time, [[profile, time or None], ...] for every profile tried]
+# starts from the first value of every pragma and tries the other values of one pragma at a time, keeping
+# any that beat the best time by more than margin, so timing noise does not change the settings.
+# profiles that fail the checks in calibrate_pragmas are never kept
+
+def autotune_storage_pragmas(db_names, table_names, out_name, candidates, repeats, margin, merge_order):
+    best = dict([(key, candidates[key][0]) for key in candidates])
+    calibrate_pragmas(db_names, table_names, out_name, best, merge_order) # warm up the page cache so the first profile is not penalised
+    trials = [[key, value] for key in candidates for value in candidates[key][1:]]
+    best_time = None
+    timings = []
+    for t in range(-1, len(trials)):
+        profile = dict(best)
+        if (t >= 0):
+            profile[trials[t][0]] = trials[t][1]
+        times = [calibrate_pragmas(db_names, table_names, out_name, profile, merge_order) for r in range(0, repeats)]
+        elapsed = None if None in times else float(np.median(times))
+        timings.append([profile, elapsed])
+        print(f"Storage profile {profile}: " + ("failed the checks" if elapsed is None else "%.3f s" % elapsed))
+        if (elapsed is not None and (best_time is None or elapsed < best_time * (1 - margin))):
+            best = profile
+            best_time = elapsed
+    return [best, best_time, timings]
+
+# 1.43 Get the centroid or bounding box columns of each object in a table
+#
+# @param table_name the name of the table (i.e. "Per_Object")
+# @return [[object, min X column, max X column, min Y column, max Y column], ...] for every object with
+#         <object>_Location_Center_X and _Y columns, using the <object>_AreaShape_BoundingBoxMinimum/Maximum_X/Y
+#         columns if they exist and the centroid (min = max) otherwise
+
+def get_spatial_columns(table_name):
+    columns = get_column_names(table_name)
+    spatial = []
+    for col in columns:
+        if col.endswith("_Location_Center_X") and (col[:-1] + "Y") in columns:
+            ob = col[:-len("_Location_Center_X")]
+            box = [f"{ob}_AreaShape_BoundingBox{end}_{axis}" for axis in ["X", "Y"] for end in ["Minimum", "Maximum"]]
+            if all(name in columns for name in box):
+                spatial.append([ob] + box)
+            else:
+                spatial.append([ob, col, col, col[:-1] + "Y", col[:-1] + "Y"])
+    return spatial
+
+# 1.44 Add the objects of an attached database to the R*Tree spatial indexes
+#
+# @param db_name the name of the (attached) database, i.e. "main" or "db_0_1"
+# @param spatial_columns the objects and their coordinate columns, from get_spatial_columns
+# @param image_key the Per_Object column partitioning the index (ImageNumber, or GroupNumber when grouping)
+# @return True if the objects were indexed, False if an insert failed (i.e. "rtree constraint failed" for a
+#         duplicate id or a min greater than its max), the uncommitted index rows are then rolled back
+# rows are added to Per_Object_RTree_<object>(id, min<image_key>, max<image_key>, minX, maxX, minY, maxY),
+# id is the ObjectNumber, objects without coordinates (or whose coordinate columns the database lacks) are left out
+
+def index_donor(db_name, spatial_columns, image_key):
+    try:
+        for [ob, min_x, max_x, min_y, max_y] in spatial_columns:
+            if len(get_select_columns('Per_Object', [min_x, max_x, min_y, max_y], db_name)[1]) > 0:
+                continue
+            curs.execute(f"INSERT INTO Per_Object_RTree_{ob} SELECT ObjectNumber, {image_key}, {image_key}, {min_x}, {max_x}, {min_y}, {max_y} "
+                         f"FROM {db_name}.Per_Object WHERE {min_x} IS NOT NULL AND {min_y} IS NOT NULL;")
+        return True
+    except sqlite3.DatabaseError:
+        traceback.print_exc()
+        conn.rollback()
+        return False
+
+# 1.45 Write the summaries of the wells whose databases have all been summarized
+#
+# @param well_summaries the running well summaries, the wells written are removed from it
+# @param well_donors {well: number of databases with images of the well that are not done yet}, updated in place
+# @param wells the wells of the database that is done (summarized, or skipped because it failed)
+# @param features, well_columns, quantiles as in write_well_summaries
+# @return the number of wells written
+# a well is only kept in memory until the last database with images of it has been merged
+
+def flush_well_summaries(well_summaries, well_donors, wells, features, well_columns, quantiles):
+    finished = {}
+    for key in set(wells):
+        well_donors[key] = well_donors.get(key, 1) - 1
+        if (well_donors[key] <= 0 and key in well_summaries):
+            finished[key] = well_summaries.pop(key)
+    if len(finished) > 0:
+        write_well_summaries(finished, features, well_columns, quantiles)
+    return len(finished)
+
 
 #################################################################################
 ############################## (2) Input Parameters #############################
@@ -297,10 +1328,153 @@ object1 = 'Object1'   # primary nuclear object e.g. 'IdentifyNuclei'
 object2 = 'Object2'   # secondary object 1
 object3 = 'Object3'   # secondary object 2
 
+# 2.6 POST-MERGE VERIFICATION
+###################################
+# row counts and checksums of the ID columns are recorded for each donor as it is merged,
+# then the merged tables are checked against them in one pass per table.
+# the results (and any other run metrics) are written to metrics_file
+
+verify_merge_output = True
+id_columns = ['ImageNumber', 'ObjectNumber', 'GroupNumber']
+metrics_file = 'merge_metrics.json'
+
+# 2.7 PER-IMAGE AND PER-WELL FEATURE SUMMARIES (optional)
+###################################
+# builds Summary_Image_<statistic> and Summary_Well_<statistic> tables (Count, Mean, StDev and Quantile_<q>)
+# for every REAL column of Per_Object while the donors are merged, so the merged output never has to be rescanned.
+# per image statistics are exact, per well quantiles are approximated from summary_sketch_size points per feature
+# each well in memory takes (summary_sketch_size + 3) * number of features * 8 bytes (i.e. 424 KB for 1000 features),
+# and a well is written and freed once the last database with images of it is merged, so list the databases
+# in filenames.txt in plate order to keep about one plate in memory
+
+build_summaries = False
+summary_well_columns = ['Image_Metadata_Plate', 'Image_Metadata_Well']
+summary_quantiles = [0.25, 0.5, 0.75]
+summary_sketch_size = 50
+
+# 2.8 DUPLICATE DATABASE DETECTION
+###################################
+# re-queued Distributed CellProfiler jobs can write the same image set twice under different file names.
+# each database is fingerprinted from its Per_Image metadata/file name/path name columns and table row counts during QC,
+# and databases that repeat images already seen in an earlier database are dropped before renumbering.
+# n_workers sets the number of databases processed at once by the parallel steps
+
+detect_duplicate_DBs = True
+n_workers = os.cpu_count() or 1
+
+# 2.9 INTEGRITY PRE-SCAN
+###################################
+# every database is checked in parallel before anything is modified: file header, page count against
+# file size, and PRAGMA quick_check ('integrity_check' is slower but more thorough, None skips the scan).
+# databases that fail are moved to quarantine_dir with a .reason.txt file
+
+integrity_check = 'quick_check'
+quarantine_dir = 'quarantine'
+
+# 2.10 CLUSTERED Per_Object OUTPUT
+###################################
+# stores the merged Per_Object as a WITHOUT ROWID table clustered on (ImageNumber, ObjectNumber), filled in key
+# order as the donors are merged, so that fetching the objects of an image is a contiguous range scan.
+# post-processing.py detects the layout and keeps it
+
+cluster_per_object = False
+
+# 2.11 PIPELINED PRE-PROCESSING
+###################################
+# donors are pre-processed (grouping, constraint removal, renumbering) by n_workers worker processes
+# while the merge writes the donors that are ready into mainDB. at most pipeline_depth donors are
+# pre-processed ahead of the merge, which bounds the extra disk space used. 0 pre-processes every
+# donor before merging (as does any system without fork, i.e. Windows and macOS)
+
+pipeline_depth = 2 * n_workers
+
+# 2.12 PACKED FEATURE VECTORS (optional)
+###################################
+# writes the REAL columns of each object into a single little-endian float32 BLOB in Per_Object_Packed
+# (ImageNumber, ObjectNumber, Features), with the feature order in Per_Object_Packed_Columns (Position, ColumnName).
+# readers can decode a chunk of rows straight into an array, i.e. numpy.frombuffer(b''.join(blobs), '<f4').
+# keep_feature_columns = False leaves the REAL columns out of Per_Object, so features are only stored packed
+# (roughly half the size, but CPA needs the columns). The object coordinates stay in Per_Object when build_spatial_index is set (see 2.16)
+
+pack_features = False
+keep_feature_columns = True
+
+# 2.13 STRATIFIED SUBSAMPLING (optional)
+###################################
+# merges a random sample of the objects instead of all of them, i.e. for exploring a screen in CPA.
+# keeps subsample_fraction (i.e. 0.05) or subsample_count objects of each image (subsample_by = 'image')
+# or of each block of 200 ObjectNumbers (subsample_by = 'group'). the sample only depends on subsample_seed
+# and the database file name, and ObjectNumbers stay contiguous. with subsample_fraction every image or block
+# keeps at least one object, so small images are not left out. both None merges every object
+
+subsample_fraction = None
+subsample_count = None
+subsample_by = 'image'
+subsample_seed = 0
+
+# 2.14 GROUPED Per_Image LAYOUT
+###################################
+# when objects are grouped into blocks of 200 (see 4.2.1), every block needs a Per_Image row for CPA.
+# group_image_mapping = True stores each image once in Per_Image_Data, with a (ImageNumber, GroupNumber)
+# mapping table Per_Image_Groups, and makes Per_Image a view with one row per block. False copies the
+# image row for every block instead
+
+group_image_mapping = False
+
+# 2.15 STORAGE PRAGMAS
+###################################
+# storage_pragmas are set on mainDB for the merge, i.e. {"page_size": 65536, "mmap_size": 268435456}.
+# with autotune_pragmas = True they are measured instead: about autotune_sample_bytes of databases are merged
+# into a scratch database next to mainDB the way section 5 merges them, under each candidate value (the first
+# value is the default). a value is kept if the median of autotune_repeats runs beats the best profile so far
+# by more than autotune_margin and passes PRAGMA quick_check and the row counts. journal_mode OFF and MEMORY
+# are never used, as a crash could corrupt the merged database
+
+storage_pragmas = {}
+autotune_pragmas = False
+autotune_sample_bytes = 256 * 2**20
+autotune_repeats = 3
+autotune_margin = 0.05
+autotune_candidates = {"page_size": [4096, 16384, 65536],
+                       "mmap_size": [0, 268435456],
+                       "cache_size": [-2000, -262144],
+                       "temp_store": [0, 2],
+                       "journal_mode": ["DELETE", "WAL"]}
+
+# 2.16 SPATIAL INDEX (optional)
+###################################
+# builds an R*Tree virtual table Per_Object_RTree_<object> for every object with Location_Center_X/Y columns
+# as the donors are merged, with one entry per object: id = ObjectNumber, min/max ImageNumber (GroupNumber when
+# grouping) and min/max X and Y (the bounding box if it was measured, otherwise the centroid). objects near a
+# point or in a region of an image are then found without scanning Per_Object
+
+build_spatial_index = False
+
 #################################################################################
 ############################# (3) Quality Control ###############################
 
-# 3.1 Initialize Connection and get main list of tables
+# 3.1 Check the integrity of every database and quarantine corrupt ones
+##################################
+
+exc_DBs = [] # create a array of DBs with tables that do not match mainDB
+
+if (integrity_check is not None):
+    startTime = time.time()
+    print(f"Checking {len(otherDBs)} databases with PRAGMA {integrity_check} and {n_workers} workers.")
+    with ThreadPoolExecutor(max_workers = n_workers) as pool:
+        problems = list(pool.map(lambda db_name: check_database(db_name, integrity_check), otherDBs))
+    corrupt_DBs = [[otherDBs[i], problems[i]] for i in range(0, len(otherDBs)) if problems[i] is not None]
+    for y in range(0, len(corrupt_DBs)):
+        quarantine_database(corrupt_DBs[y][0], corrupt_DBs[y][1], quarantine_dir)
+        exc_DBs.append([corrupt_DBs[y][0], corrupt_DBs[y][1] + f" Database moved to {quarantine_dir}."])
+        otherDBs.remove(corrupt_DBs[y][0])
+    run_metrics["corrupt_DBs"] = corrupt_DBs
+    print(f"Quarantined {len(corrupt_DBs)} databases. Time elapsed: %.3f" % (time.time() - startTime))
+    if not os.path.exists(mainDB):
+        print(f"ERROR: The main database {mainDB} failed the integrity check and was quarantined. Choose another mainDB.")
+        sys.exit()
+
+# 3.2 Initialize Connection and get main list of tables
 ################################## 
 
 conn = sqlite3.connect(mainDB)  # Connect to the main database
@@ -308,14 +1482,15 @@ curs = conn.cursor()  # Connect a cursor
 listTable = get_table_names()  # Get the table names
 listTable.sort()
 close_connection()
+merge_order = {'Per_Object': 'ImageNumber, ObjectNumber'} if cluster_per_object else {} # tables merged in key order (see 2.10)
 
-# 3.2 Compare databases for quality control
+# 3.3 Compare databases for quality control
 ##################################
 
 startTime = time.time()
 print("Comparing databases. Started at: " + strftime("%H:%M", gmtime()))
-exc_DBs = [] # create a array of DBs with tables that do not match mainDB
 
+union_schema = {} # union of the columns of each table across the databases, see 5.1
 i=0 #iterator
 while i < len(otherDBs):
     conn = sqlite3.connect(otherDBs[i])
@@ -328,25 +1503,40 @@ while i < len(otherDBs):
         continue
     if len(listTable) < len(temp):
         exc_DBs.append([otherDBs[i], "Reason: Extra Table(s) can not be merged, database included in merge."])
-        continue
-    if listTable != temp:
+    elif listTable != temp:
         exc_DBs.append([otherDBs[i], "Reason: Table(s) did not match, database excluded from merge."])
         otherDBs.remove(otherDBs[i])  # Remove the table to avoid errors
         continue
-    if listTable == temp:
-        i += 1
-        continue
+    for t in range(0, len(listTable)):  # Add the columns of each table to the union schema
+        if listTable[t] in temp:
+            add_to_schema(union_schema, listTable[t], get_column_names_types(listTable[t]))
+    i += 1
     close_connection()
-    num = len(otherDBs)
-    print(f"There are {num} databases whose tables matched the main database.")
+num = len(otherDBs)
+print(f"There are {num} databases whose tables matched the main database.")
+
+# 3.4 Drop duplicate and overlapping databases
+##################################
 
-# 3.3 Log exceptions that were removed or otherwise not a good fit for merge
+if (detect_duplicate_DBs):
+    print(f"Fingerprinting {len(otherDBs)} databases with {n_workers} workers.")
+    with ThreadPoolExecutor(max_workers = n_workers) as pool:
+        fingerprints = list(pool.map(lambda db_name: fingerprint_database(db_name, listTable), otherDBs))
+    duplicate_DBs = find_duplicate_databases(otherDBs, fingerprints)
+    for y in range(0, len(duplicate_DBs)):
+        exc_DBs.append(duplicate_DBs[y])
+        otherDBs.remove(duplicate_DBs[y][0])
+    print(f"Found {len(duplicate_DBs)} duplicate or overlapping databases.")
+    run_metrics["duplicate_DBs"] = duplicate_DBs
+    del fingerprints
+
+# 3.5 Log exceptions that were removed or otherwise not a good fit for merge
 ################################## 
 
 for y in range(0, len(exc_DBs)):
    print(f"{exc_DBs[y][0]} was logged as an exception. {exc_DBs[y][1]}")
 
-# 3.4 Log errors when no otherDBs were found
+# 3.6 Log errors when no otherDBs were found
 ################################## 
 
 if len(otherDBs) == 0:
@@ -354,12 +1544,34 @@ if len(otherDBs) == 0:
           inconsistencies, or databases were not added properly.")
     sys.exit()
 
-# 3.5 Print notification that quality control is complete
+# 3.7 Print notification that quality control is complete
 ##################################
 
 print("Finished comparing databases. Time elapsed: %.3f" % (time.time() -
                                                             startTime))
 
+# 3.8 Calibrate the storage pragmas on a sample of the databases
+##################################
+#### Runs before pre-processing, the sampled databases are attached read-only and are not changed
+
+if (autotune_pragmas):
+    startTime = time.time()
+    candidates = dict(autotune_candidates)
+    if ("journal_mode" in candidates): # a crash with journal_mode OFF or MEMORY can corrupt the database
+        candidates["journal_mode"] = [mode for mode in candidates["journal_mode"] if mode.upper() not in ["OFF", "MEMORY"]]
+    ## enough databases, spread over the list, to make up about autotune_sample_bytes
+    db_bytes = sum([os.path.getsize(db_name) for db_name in otherDBs])
+    n_sample = min(len(otherDBs), max(1, -(-autotune_sample_bytes * len(otherDBs) // max(db_bytes, 1))))
+    sample_DBs = [otherDBs[k * len(otherDBs) // n_sample] for k in range(0, n_sample)]
+    sample_bytes = sum([os.path.getsize(db_name) for db_name in sample_DBs])
+    print(f"Calibrating storage pragmas on {len(sample_DBs)} databases ({sample_bytes / 2**20:.0f} MB). Started at: " + strftime("%H:%M", gmtime()))
+    [storage_pragmas, best_time, timings] = autotune_storage_pragmas(sample_DBs, listTable, f"{mainDB}.autotune", candidates,
+                                                                     autotune_repeats, autotune_margin, merge_order)
+    print(f"Using storage pragmas {storage_pragmas} (%s per calibration merge). Time elapsed: %.3f"
+          % ("failed" if best_time is None else "%.3f s" % best_time, time.time() - startTime))
+    run_metrics["autotune"] = {"sample_DBs": sample_DBs, "sample_bytes": sample_bytes, "best_time": best_time, "timings": timings}
+run_metrics["storage_pragmas"] = storage_pragmas
+
 #################################################################################
 ############################ (4) Pre-Processing #################################
 
@@ -375,91 +1587,16 @@ print("Pre-processing databases initiated at: " + strftime("%H:%M", gmtime()))
 
 # 4.2 Pre-processing module produces a donor table based on the template of the original
 ##################################
-## 4.2.1: A loop that deals with SingleObjectView CP Output
-## 4.2.2: A loop that checks the number of objects for an image to determine if there
-#            are >10000 objects per image. Another loop that adds GroupNumber to the table 
-#            to allow image sub-grouping for tables with more than 1000 objects per image
-## 4.3.3: A loop that removes column constraints and renumbers relevant columns in the
-##           Per_Object and Per_Image tables
-
-
-# 4.2.1 Per_Object Table Creation Loop
-#### Scheme - make per object tables in each of the otherDBs using left join
-#### then insert/merge all DBs
+## 4.2.1: Counts the objects in each database (after creating Per_Object from SingleObjectView CP Output
+##           and subsampling the objects if set in 2.13), checks if any database has >200 objects to decide on ImageNumber grouping, and works out
+##           the ImageNumber, GroupNumber and ObjectNumber offsets of every database from the counts
+## 4.2.2: Starts the pre-processing pipeline, where worker processes add GroupNumber (if grouping), remove column
+##           constraints and renumber relevant columns in each database, using the offsets from 4.2.1.
+##           Databases are merged in section 5 as soon as they are ready
 
 # Define objects
 objects = (object1, object2, object3)
 
-if (db_type == 'SingleObjectView'):
-    for h in range(0, len(otherDBs)):                                                                                                               # databases loop (each database from one image)
-        conn = sqlite3.connect(otherDBs[h], timeout = 10)
-        curs = conn.cursor()
-        lngt = len(otherDBs)
-        now = h + 1
-        print(f"Processing SingleObjectView Tables. Now processing {now} of {lngt}")
-        curs.execute("PRAGMA legacy_alter_table = TRUE;")
-    ### part 1 - rename ImangeNumber in the original per_object(n) tables
-        for f in range(0, len(objects)):
-            # get column names/types for object(n) table and rename ImageNumber column
-            ob = objects[f]
-            curs.execute(f"ALTER TABLE Per_{ob} RENAME COLUMN ImageNumber TO {ob}_ImageNumber")
-            # add img_no and obj_no cols to be renumbered later (CP requires UNIQUE img and obj number columns in the final aggregated tables)
-            curs.execute(f"ALTER TABLE Per_{ob} ADD {ob}_img_no integer;")
-            curs.execute(f"ALTER TABLE Per_{ob} ADD {ob}_obj_no integer;")
-            curs.execute(f"UPDATE Per_{ob} SET {ob}_obj_no = {ob}_Number_Object_Number")
-            conn.commit()
-    ### Add corresponding img_no column in Per_Image
-        curs.execute("ALTER TABLE Per_Image ADD img_no integer;")
-    ### part 2 - make the per-object table
-        # Drop per_object views if exists
-        curs.execute("SELECT name FROM sqlite_master WHERE type = 'view';")
-        views = curs.fetchall()
-        for x in range(0, len(views)):
-            curs.execute(f"DROP VIEW IF EXISTS {views[x][0]}")
-        conn.commit()
-        # produce list of column names and types from each per_object(n) table to make the Per_Object table (and adds objectnumber column)
-        colnamtyps = []
-        for f in range(0, len(objects)):
-            ob = objects[f]
-            c = get_column_names_types(f"Per_{ob}")
-            colnamtyps = colnamtyps + c
-        colnamtyps.insert(1, ['obj_no', "INTEGER"]) #insert ObjectNumber column at 2nd positon
-        colnamtyps_PO = list_to_string(colnamtyps, 2)
-        # Creates Per_Object Table
-        curs.execute(f"CREATE TABLE Per_Object({colnamtyps_PO})")
-        conn.commit()
-    ### Part 3 - put data in the Per_Object Table
-        # get column names for Per_Obj statement
-        colnams_po = list_to_string(get_column_names('Per_Object'), 1)
-        # get column names for select statment
-        colnams_sel = []
-        for e in range(0, len(objects)):
-            ob = objects[e]
-            c = get_column_names(f"Per_{ob}")
-            colnams_sel = colnams_sel + c
-        colnams_sel.insert(1, f"{object1}_Number_Object_Number") #to insert data from primaryobj_Number_Object_Number into the column ObjectNumber
-        colnams_sel = list_to_string(colnams_sel, 1)
-        # insert data (comment in/out left or inner join)
-        #LeftJoin = f"INSERT INTO Per_Object({colnams_po}) SELECT {colnams_sel} FROM Per_{object1} LEFT JOIN Per_{object2} ON Per_{object1}.{object1}_ImageNumber = Per_{object2}.{object2}_ImageNumber AND Per_{object1}.{object1}_Number_Object_Number = Per_{object2}.{object2}_Parent_{object1} LEFT JOIN Per_{object3} ON Per_{object1}.{object1}_ImageNumber = Per_{object3}.{object3}_ImageNumber AND Per_{object1}.{object1}_Number_Object_Number = Per_{object3}.{object3}_Parent_{object1};"
-        InnerJoin = f"INSERT INTO Per_Object({colnams_po}) SELECT {colnams_sel} FROM Per_{object1} INNER JOIN Per_{object2} ON Per_{object1}.{object1}_ImageNumber = Per_{object2}.{object2}_ImageNumber AND Per_{object1}.{object1}_Number_Object_Number = Per_{object2}.{object2}_Parent_{object1} INNER JOIN Per_{object3} ON Per_{object1}.{object1}_ImageNumber = Per_{object3}.{object3}_ImageNumber AND Per_{object1}.{object1}_Number_Object_Number = Per_{object3}.{object3}_Parent_{object1};"
-        curs.execute(InnerJoin)
-        conn.commit()
-        # remove excess image number columns
-        for d in range(1, len(objects)):
-            ob = objects[d]
-            curs.execute(f"ALTER TABLE Per_Object DROP COLUMN {ob}_ImageNumber;")
-            conn.commit()
-        curs.execute(f"ALTER TABLE Per_Object RENAME COLUMN {object1}_ImageNumber TO img_no;")
-        # remove excess columns
-        for v in range(0, len(objects)):
-            ob = objects[v]
-            curs.execute(f"ALTER TABLE Per_Object DROP COLUMN {ob}_img_no;")
-        close_connection()
-    ## time check
-    print("Object Tables Created. Time elapsed: %.3f" % (time.time() -
-                                                        startTime))
-
-
 # variable defintions - if using the pre-processing part (1) for per_object views,
 # set img_no and obj_no = to themselves, otherwise use the column names 'ImageNumber'
 # 'ObjectNUmber' and 'Number_ObjectNumber'
@@ -467,283 +1604,61 @@ if (db_type == 'SingleObjectView'):
 if (db_type == 'SingleObjectView'):
     img_no = 'img_no'
     obj_no = 'obj_no'
-    no_ob_no = 'obj_no'
+    no_obj_no = 'obj_no'
 elif (db_type == 'SingleObjectTable'):
     img_no = 'ImageNumber'
     obj_no = 'ObjectNumber'
     no_obj_no = 'Number_Object_Number'
 
 
-# 4.2.2 Check Object Numbers
-#### A loop that checks the number of objects for an image to determine if there
-#### are >200 objects per image
-
-checklength = []
-
-for h in range(0, len(otherDBs)):
-    conn = sqlite3.connect(otherDBs[h], timeout = 10)
-    curs = conn.cursor()
-    curs.execute(f"SELECT COUNT ({obj_no}) FROM Per_Object;")
-    chk = curs.fetchone()
-    chk = int(chk[0])
-    checklength.append(chk)
+# 4.2.1 Count Objects and Compute Offsets
+#### The numbering of each database only depends on the counts of the databases before it,
+#### so once the counts are known every database can be pre-processed independently
 
-do_grouping = any(x > 200 for x in checklength)
+counts = map_databases(count_database, otherDBs, n_workers)
+do_grouping = any(count[0] > 200 for count in counts)
+if (counts[0][3] is not None):
+    n_before = sum(count[3][0] for count in counts)
+    n_kept = sum(count[3][1] for count in counts)
+    print(f"Subsampled {n_kept} of {n_before} objects by {subsample_by} (seed {subsample_seed}).")
+    run_metrics["subsample"] = {"by": subsample_by, "fraction": subsample_fraction, "count": subsample_count,
+                                "seed": subsample_seed, "objects_before": n_before, "objects_kept": n_kept}
 
 ## Adds GroupNumber column to Per_Object Table if there are any images with more than 200 objects per image.
 ## The GroupNumber column and the ImageNumber column will be swapped so that the "Group" is actually the image
 ## and images will be processed as subsets of 200 objects. The Per_Image table will be updated to have a record
 ## for each GroupNumber. Finally, the ImageNumber Column and GroupNumber column will be swapped.
-
-#set the group iterator
-grpit = 1
-
 if (do_grouping):
     print("One or more of your databases has more than 1k objects per image, a GroupNumber column will be added to all databases.")
-    group = 0
-    for h in range(0, len(otherDBs)):
-    ## Connect to DB
-        conn = sqlite3.connect(otherDBs[h], timeout = 10)
-        curs = conn.cursor()
-        lngt = len(otherDBs)
-    ## Get and sort tables from DB
-        listTable = get_table_names()
-        listTable.sort()
-    ## Communicate step
-        now = h + 1
-        print(f"Adding GroupNumber to {otherDBs[h]}: Per_Object Table. Processing {now} of {lngt}")
-###### ObjectNumber table #######
-    ## Get ObjectNumber count from Per_Object table and initialize variables
-      ## Get the ObjectNumber column from Per_Object
-        curs.execute(f"SELECT {obj_no} FROM Per_Object;")
-        objno = curs.fetchall()
-      ## Set variables for lists
-        grp_id = []
-        obj_id = fetch_to_list(objno)
-    ## Create two lists, one that corresponds to entries in the ObjectNumber column
-    ## and one that produces a group_id for each 1000 entries in the ObjectNumber column
-        for x in obj_id:
-            grp_id.append(grpit) #create a list of group_ids that increments per 200 ObjectNumbers
-            if (x % 200 == 0):
-                grpit += 1
-            else:
-                continue
-        grpit += 1 #augment group iterator by one for next image
-    ## Create a dataframe from the lists
-        data = {f'Object_no':obj_id, 'GroupNumber':grp_id}
-        df = pd.DataFrame(data)
-    ## Send the dataframe to sqlite3 grpnum table and remove objects from env
-        df.to_sql('grpnum', conn, schema='main', index = False, chunksize = 1000, method = 'multi')
-        del data
-        del df
-        conn.commit()
-    ## Initialize column designations for grouping statement
-        colnamtyp = list_to_string(get_column_names_types('Per_Object'), 2)
-        colnamtyp = "GroupNumber INTEGER, " + colnamtyp
-        colnam = list_to_string(get_column_names('Per_Object'), 1)
-        colnam = "GroupNumber, " + colnam
-    ## Create a join statement and create a joined table
-        SelectJoin = f"SELECT {colnam} FROM Per_Object INNER JOIN grpnum ON grpnum.Object_no = Per_Object.{obj_no}"
-        curs.execute(f"CREATE TABLE Joiner({colnamtyp});")
-        curs.execute(f"INSERT INTO Joiner({colnam}) {SelectJoin};")
-        conn.commit()
-    ## Remove the old Grouping and Per_Object tables and rename Joiner to Per_Object
-        curs.execute("DROP TABLE IF EXISTS grpnum;")
-        curs.execute("DROP TABLE IF EXISTS Per_Object;")
-        curs.execute("ALTER TABLE Joiner RENAME TO Per_Object;")
-        print(f"Objects are now grouped into blocks of 200 by ImageNumber in {otherDBs[h]}.Per_Object... Use GroupNumber to filter by Image")
-        conn.commit()
-###### ImageNumber table #######
-     ## Get table info
-     ## In this case, don't use column types for joiner to avoid ImageNumber Unique constraint
-        colnam = list_to_string(get_column_names('Per_Image'), 1)
-        colnam = "GroupNumber, " + colnam
-     ## Create a grouping table
-        curs.execute(f"CREATE TABLE grpnum(GroupNumber INTEGER, {img_no} INTEGER);")
-        curs.execute(f"INSERT INTO grpnum(GroupNumber, {img_no}) SELECT DISTINCT GroupNumber, {img_no} FROM Per_Object ORDER BY GroupNumber;")
-     ## Create a pandas dataframe to re-create the Per_Image table including the revised group numbering
-        grpnum = pd.read_sql_query("SELECT * FROM grpnum;", conn)
-        perimg = pd.read_sql_query("SELECT * FROM Per_Image;", conn)
-        for (columnName, columnData) in perimg.iteritems():
-            if (f"{columnName}" == f'{img_no}' or f"{columnName}" == 'GroupNumber'):
-                continue
-            else:
-                grpnum[f'{columnName}'] = columnData[0]
-    ## Send the new perimg dataframe to sqlite
-        grpnum.to_sql('perimg', conn, schema='main', index = False, chunksize = 1000, method = 'multi')
-        del perimg
-        del grpnum
-        conn.commit()
-     ## Create a the new Per_Image_ table and insert the dataframe records
-        curs.execute(f"CREATE TABLE Per_Image_({colnam});")
-        curs.execute(f"INSERT INTO Per_Image_({colnam}) SELECT {colnam} FROM perimg;")
-        conn.commit()
-     ## Renaming Columns for Both Tables
-        swap_column_names("Per_Image_", "GroupNumber", f"{img_no}")
-        swap_column_names("Per_Object", "GroupNumber", f"{img_no}")
-        conn.commit()
-     ## Get rid of old tables
-        curs.execute("DROP TABLE IF EXISTS grpnum;")
-        curs.execute("DROP TABLE IF EXISTS perimg;")
-        curs.execute("DROP TABLE IF EXISTS Per_Image;")
-        curs.execute("ALTER TABLE Per_Image_ RENAME TO Per_Image;")
-        print(f"{otherDBs[h]}.Per_Image ImageNumbers have now been updated to reflect the ImageNumber grouping in Per_Object... Use GroupNumber to filter by Image")
-        conn.commit()
-close_connection()
 
-## time check
-print("Object Grouping Completed. Time elapsed: %.3f" % (time.time() -
-                                                         startTime))
+## ImageNumbers follow the database order, a database uses one group per 200 ObjectNumbers (plus one), and the
+## ObjectNumbers of each object continue from the databases before it
+offsets = []
+grpit = 1
+obj = [0, 0, 0]
+for h in range(0, len(otherDBs)):
+    offsets.append({"img": h + 1, "grp": grpit, "obj": list(obj)})
+    grpit += counts[h][1] + 1
+    obj = [obj[k] + counts[h][2][k] for k in range(0, 3)]
 
-# 4.2.3 Renumbering Loop
-#### For any columns which require unique values in CP (ImageNumber, ObjectNumber, etc), we can renumber the objects
-#### in the same sequence they will be merged so that the numbering will be continuous after the merge.
+## The wells of each database, so a well summary can be written as soon as its last database is merged (see 5.2)
+donor_wells = dict([(otherDBs[h], counts[h][4]) for h in range(0, len(otherDBs))])
 
-# counters
-img = 0
-obj_1 = 0
-obj_2 = 0
-obj_3 = 0
+print("Objects Counted. Time elapsed: %.3f" % (time.time() -
+                                               startTime))
 
+# 4.2.2 Pre-processing Pipeline
+#### mainDB (the first database) has to be pre-processed before anything is merged into it,
+#### the other databases are pre-processed while section 5 merges them
 
-### databases loop
-for h in range(0, len(otherDBs)):
-### make connection to db
-    conn = sqlite3.connect(otherDBs[h], timeout = 10)
-    curs = conn.cursor()
-### get db info
-    lngt = len(otherDBs)
-    listTable = get_table_names()
-    listTable.sort()
-    now = h + 1
-    print(f"Renumbering objects. Processing {now} of {lngt}")
-### sorts listTable so that Per_Object table is last and renumbering happens correctly
-    listTable.append(listTable.pop(listTable.index('Per_Object')))
-### re/set counters for looping
-    img += 1
-    is_run1 = 0
-    is_run2 = 0
-    is_run3 = 0
-###
-### remove column constraints (each table from each database)
-    for g in range(0, len(listTable)):
-        colnamtyp = list_to_string(get_column_names_types(listTable[g]), 2)
-        colnam = list_to_string(get_column_names(listTable[g]), 1)
-        colset = set(colnam)
-        curs.execute("PRAGMA legacy_alter_table = TRUE;")
-        curs.execute(f"CREATE TABLE _{listTable[g]}({colnamtyp});")
-        curs.execute(f"INSERT INTO _{listTable[g]}({colnam}) SELECT {colnam} FROM {listTable[g]};")
-        curs.execute(f"DROP TABLE {listTable[g]};")
-        curs.execute(f"ALTER TABLE _{listTable[g]} RENAME TO {listTable[g]};")
-        conn.commit()
-#######
-####### Per_Image ImageNumber renumbering statements
-        if (f"{listTable[g]}" == "Per_Image"):
-            if (do_grouping):
-                curs.execute(f"UPDATE {listTable[g]} SET GroupNumber = {img};")
-            else:
-                curs.execute(f"UPDATE {listTable[g]} SET {img_no} = {img};")
-            if (db_type == 'SingleObjectView'):
-                curs.execute(f"ALTER TABLE {listTable[g]} DROP COLUMN IF EXISTS ImageNumber;")
-            print(f"Runumbering {img_no} in {otherDBs[h]}: Per_Image table")
-            conn.commit()
-#######
-####### Per_Object1 Table ImageNumber and ObjectNumber renumbering statements for SingleObjectView
-        elif (f"{listTable[g]}" == f'Per_{object1}'):
-            curs.execute(f"UPDATE {listTable[g]} SET {object1}_{img_no} = {img};")
-            curs.execute(f"UPDATE {listTable[g]} SET {object1}_{no_obj_no} = {object1}_{no_obj_no} + {obj_1};")
-            curs.execute(f"SELECT COUNT ({object1}_{no_obj_no}) FROM {listTable[g]};")
-            temp = curs.fetchone()
-            obj_1_temp = obj_1 #hold obj_1 value for per_object table
-            obj_1 += temp[0]   #augment obj_1 for next loop
-            is_run1 = 1
-            print(f"Runumbering ImageNumber and ObjectNumber columns in {otherDBs[h]}: Per_{object1} table")
-            conn.commit()
-#######
-####### Per_Object2 Table ImageNumber and ObjectNumber renumbering statements for SingleObjectView
-        elif (f"{listTable[g]}" == f'Per_{object2}'):
-            curs.execute(f"UPDATE {listTable[g]} SET {object2}_{img_no} = {img};")
-            curs.execute(f"UPDATE {listTable[g]} SET {object2}_{no_obj_no} = {object2}_{no_obj_no} + {obj_2};")
-            curs.execute(f"SELECT COUNT ({object2}_{no_obj_no}) FROM {listTable[g]};")
-            temp = curs.fetchone()
-            obj_2_temp = obj_2 #hold obj_2 value for per_object table
-            obj_2 += temp[0]   #augment obj_2 for next loop
-            is_run2 = 1
-            print(f"Runumbering ImageNumber and ObjectNumber columns in {otherDBs[h]}: Per_{object2} table")
-            conn.commit()
-#######
-####### Per_Object3 Table ImageNumber and ObjectNumber renumbering statements for SingleObjectView
-        elif (f"{listTable[g]}" == f'Per_{object3}'):
-            curs.execute(f"UPDATE {listTable[g]} SET '{object3}_{img_no}' = {img};")
-            curs.execute(f"UPDATE {listTable[g]} SET {object3}_{no_obj_no} = {object3}_{no_obj_no} + {obj_3};")
-            curs.execute(f"SELECT COUNT ({object3}_{no_obj_no}) FROM {listTable[g]};")
-            temp = curs.fetchone()
-            obj_3_temp = obj_3 #hold obj_3 value for per_object table
-            obj_3 += temp[0]   #augment obj_3 for next loop
-            is_run3 = 1
-            print(f"Runumbering ImageNumber and ObjectNumber columns in {otherDBs[h]}: Per_{object3} table")
-            conn.commit()
-#######
-####### Set SingleObjectTable counters
-        elif (f"{listTable[g]}" == 'Per_Object'):
-            if (db_type == 'SingleObjectTable'):
-                if (is_run1 != 1):
-                    curs.execute(f"SELECT COUNT ({object1}_{no_obj_no}) FROM {listTable[g]};")
-                    temp = curs.fetchone()
-                    obj_1_temp = obj_1
-                    obj_1 += temp[0]
-                if (is_run2 != 1):
-                    curs.execute(f"SELECT COUNT ({object2}_{no_obj_no}) FROM {listTable[g]};")
-                    temp = curs.fetchone()
-                    obj_2_temp = obj_2
-                    obj_2 += temp[0]
-                if (is_run3 != 1):
-                    curs.execute(f"SELECT COUNT ({object3}_{no_obj_no}) FROM {listTable[g]};")
-                    temp = curs.fetchone()
-                    obj_3_temp = obj_3
-                    obj_3 += temp[0]
-###########
-########### Per_Object Table ImageNumber and ObjectNumber renumbering statements
-            print(f"Runumbering ImageNumber and ObjectNumber columns in {otherDBs[h]}: {listTable[g]} table")
-###########
-########### Renumber ImageNumber Column
-            if (do_grouping):
-                curs.execute(f"UPDATE {listTable[g]} SET GroupNumber = {img};")
-            else:
-                curs.execute(f"UPDATE {listTable[g]} SET {img_no} = {img};")
-###########
-########### NB. CONDITIONAL UPDATE SYNTAX Table_Name SET Column = CASE WHEN (Column IS NULL) THEN (Column) ELSE (Column + MATH) END;
-########### Renumber ObjectNumber the same way as object1, conditional for non-null values
-            curs.execute(f"UPDATE {listTable[g]} SET {obj_no} = CASE WHEN ({obj_no} IS NULL) THEN ({obj_no}) ELSE ({obj_no} + {obj_1_temp}) END;")
-###########
-########### Renumber object1 if not null (left join may produce null values)
-            curs.execute(f"UPDATE {listTable[g]} SET {object1}_{no_obj_no} = CASE WHEN ({object1}_{no_obj_no} IS NULL) THEN ({object1}_{no_obj_no}) ELSE ({object1}_{no_obj_no} + {obj_1_temp}) END;")
-###########
-########### Renumber object2 if not null (left join may produce null values)
-            curs.execute(f"UPDATE {listTable[g]} SET {object2}_{no_obj_no} = CASE WHEN ({object2}_{no_obj_no} IS NULL) THEN ({object2}_{no_obj_no}) ELSE ({object2}_{no_obj_no} + {obj_2_temp}) END;")
-###########
-########### Renumber object3 if not null (left join may produce null values)
-            curs.execute(f"UPDATE {listTable[g]} SET {object3}_{no_obj_no} = CASE WHEN ({object3}_{no_obj_no} IS NULL) THEN ({object3}_{no_obj_no}) ELSE ({object3}_{no_obj_no} + {obj_3_temp}) END;")
-###########
-########### Commit Changes and remove temporary stored variables
-            conn.commit()
-            del obj_1_temp
-            del obj_2_temp
-            del obj_3_temp
-        else:
-            continue
-############
-############ Rename img_no and obj_no columns in Per_Object table created from SingleObjectView output
-    if (db_type == 'SingleObjectView'):
-        curs.execute("ALTER TABLE Per_Image RENAME COLUMN {img_no} TO ImageNumber;")
-        curs.execute("ALTER TABLE Per_Image RENAME COLUMN {obj_no} TO ObjectNumber;")
-        curs.execute("ALTER TABLE Per_Object RENAME COLUMN {img_no} TO ImageNumber;")
-        curs.execute("ALTER TABLE Per_Image RENAME COLUMN {obj_no} TO ObjectNumber;")
-        conn.commit()
-### Close Connection and communicate time check
-    close_connection()
-    print(f"Pre-processing of {otherDBs[h]} complete). Time elapsed: %.3f" % (time.time() -
-                                                                              startTime))
+prepared = preprocess_pipeline(list(otherDBs), offsets, do_grouping, n_workers, pipeline_depth)
+if (otherDBs[0] == mainDB):
+    [db_name, error] = next(prepared)
+    if error is not None:
+        print(f"ERROR: Pre-processing of the main database {mainDB} failed.\n{error}")
+        sys.exit()
+print(f"Pre-processing of {mainDB} complete. Time elapsed: %.3f" % (time.time() -
+                                                                   startTime))
 
 
 #################################################################################
@@ -760,27 +1675,214 @@ nBlocks = len(DBs_attacher)
 Total_DBs_attacher = int(sum([len(block) for block in DBs_attacher]))
 print("Total: "+str(Total_DBs_attacher)+" Blocks: "+str(nBlocks))
 
+## get the tables to merge from mainDB, with Per_Object last
+conn = sqlite3.connect(mainDB, timeout = 15)
+curs = conn.cursor()
+set_storage_pragmas(storage_pragmas, True) # set the page size of the merged database (see 2.15)
+listTable = get_table_names()
+listTable.sort()
+listTable.append(listTable.pop(listTable.index('Per_Object')))
+
+## add the columns of the union schema (see 3.3) that mainDB is missing, donors lacking a column fill it with NULL.
+## for SingleObjectView output the Per_Object columns come from the per object(n) tables
+if (db_type == 'SingleObjectView'):
+    for ob in objects:
+        ob_columns = union_schema.get(f"Per_{ob}", [])
+        add_to_schema(union_schema, 'Per_Object', [col for col in ob_columns if col[0] != 'ImageNumber'])
+        union_schema[f"Per_{ob}"] = [[f"{ob}_ImageNumber", col[1]] if col[0] == 'ImageNumber' else col for col in ob_columns]
+## with group_image_mapping the image number column of Per_Image became GroupNumber (see 4.2.2)
+if (do_grouping and group_image_mapping):
+    union_schema['Per_Image'] = [['GroupNumber', col[1]] if col[0] == img_no else col for col in union_schema.get('Per_Image', [])]
+schema_drift = {}
+for j in range(0, len(listTable)):
+    added = reconcile_table(listTable[j], union_schema.get(listTable[j], []))
+    if len(added) > 0:
+        print(f"Added {len(added)} columns found in other databases to {mainDB}.{listTable[j]}: {list_to_string(added, 1)}")
+        schema_drift[f"{mainDB}.{listTable[j]}"] = added
+
+## record the aggregates already in mainDB, the donor aggregates are added to these as they are read
+merge_aggregates = {}
+failed_merges = []
+for j in range(0, len(listTable)):
+    merge_aggregates[listTable[j]] = get_table_aggregates(listTable[j], id_columns)
+## summarize the objects already in mainDB, the donors are summarized as they are merged
+if (build_summaries):
+    summary_image_key = 'GroupNumber' if do_grouping else 'ImageNumber'
+    summary_join_key = 'GroupNumber' if (do_grouping and group_image_mapping) else 'ImageNumber'
+    summary_features = get_feature_columns('Per_Object', id_columns)
+    well_positions = [k for k in range(0, len(summary_well_columns)) if summary_well_columns[k] in get_column_names('Per_Image')]
+    summary_well_columns = [summary_well_columns[k] for k in well_positions]
+    well_summaries = {}
+    ## count the databases with images of each well, a well is written and dropped from memory once all of them are merged
+    well_donors = {}
+    for db in donor_wells:
+        donor_wells[db] = [tuple(well[k] for k in well_positions) for well in donor_wells[db]]
+        for well in set(donor_wells[db]):
+            well_donors[well] = well_donors.get(well, 0) + 1
+    wells_written = 0
+    for stat in ["Count", "Mean", "StDev"] + [f"Quantile_{int(round(q * 100))}" for q in summary_quantiles]:
+        curs.execute(f"DROP TABLE IF EXISTS Summary_Image_{stat};")
+        curs.execute(f"DROP TABLE IF EXISTS Summary_Well_{stat};")
+    summarize_donor("main", summary_features, summary_image_key, summary_well_columns,
+                    summary_quantiles, summary_sketch_size, well_summaries, summary_join_key)
+    if len(summary_well_columns) > 0:
+        wells_written += flush_well_summaries(well_summaries, well_donors, donor_wells[mainDB],
+                                              summary_features, summary_well_columns, summary_quantiles)
+    conn.commit()
+## pack the features of mainDB, the donors are packed as they are merged
+if (pack_features):
+    packed_features = get_feature_columns('Per_Object', id_columns)
+    curs.execute("DROP TABLE IF EXISTS Per_Object_Packed;")
+    curs.execute("DROP TABLE IF EXISTS Per_Object_Packed_Columns;")
+    curs.execute("CREATE TABLE Per_Object_Packed(ImageNumber INTEGER, ObjectNumber INTEGER, Features BLOB);")
+    curs.execute("CREATE TABLE Per_Object_Packed_Columns(Position INTEGER PRIMARY KEY, ColumnName TEXT);")
+    curs.executemany("INSERT INTO Per_Object_Packed_Columns(Position, ColumnName) VALUES (?, ?);",
+                     [(k, packed_features[k]) for k in range(0, len(packed_features))])
+    print(f"Packing {len(packed_features)} features of Per_Object into float32 vectors.")
+    pack_donor("main", packed_features)
+    conn.commit()
+    if not keep_feature_columns:
+        ## the merge only copies the columns left in mainDB's Per_Object, the coordinates are kept for the spatial index (see 2.16)
+        spatial_coordinates = [col for entry in get_spatial_columns('Per_Object') for col in entry[1:]] if build_spatial_index else []
+        keep_columns('Per_Object', [col for col in get_column_names('Per_Object') if col not in packed_features or col in spatial_coordinates])
+## index the objects of mainDB, the donors are indexed as they are merged
+if (build_spatial_index):
+    spatial_image_key = 'GroupNumber' if do_grouping else 'ImageNumber'
+    spatial_columns = get_spatial_columns('Per_Object')
+    try:
+        for [ob, min_x, max_x, min_y, max_y] in spatial_columns:
+            curs.execute(f"DROP TABLE IF EXISTS Per_Object_RTree_{ob};")
+            curs.execute(f"CREATE VIRTUAL TABLE Per_Object_RTree_{ob} USING rtree(id, min{spatial_image_key}, max{spatial_image_key}, minX, maxX, minY, maxY);")
+        if not index_donor("main", spatial_columns, spatial_image_key):
+            print(f"WARNING: The objects of {mainDB} could not be indexed, no spatial index will be built.")
+            build_spatial_index = False
+    except sqlite3.OperationalError as e:
+        if "no such module" not in str(e):
+            raise
+        print("WARNING: This SQLite build has no R*Tree module, no spatial index will be built.")
+        build_spatial_index = False
+    if (build_spatial_index and len(spatial_columns) > 0):
+        print(f"Building R*Tree spatial indexes for {len(spatial_columns)} objects: {list_to_string([col[0] for col in spatial_columns], 1)}")
+    elif (build_spatial_index):
+        print("WARNING: Per_Object has no Location_Center or AreaShape_BoundingBox columns, no spatial index will be built.")
+        build_spatial_index = False
+    conn.commit()
+## rebuild mainDB's Per_Object clustered on its key, donors are then appended in key order
+if ('Per_Object' in merge_order):
+    cluster_table('Per_Object', ['ImageNumber', 'ObjectNumber'])
+    print("Per_Object will be clustered on (ImageNumber, ObjectNumber).")
+close_connection()
+
 # 5.2 Database Merge Loop
 #### A nested for loop iterates through the blocks in this version
-#### to prevent an error from trying to attach more than ten DBs at a time
+#### to prevent an error from trying to attach more than ten DBs at a time.
+#### Each database is taken from the pre-processing pipeline as soon as it is ready
 
 for u in range(0, len(DBs_attacher)):                                                                  # Block level iterator
     conn = sqlite3.connect(mainDB, timeout = 15)                                                       # Attach main database
     curs = conn.cursor()                                                                               # Attach cursor
+    set_storage_pragmas(storage_pragmas)                                                               # Set the storage pragmas (see 2.15)
     listDB.append([])                                                                                  # Add a new block to listDB
     now = u+1
     print("Now processing: "+str(now)+" of "+str(nBlocks))
     for n in range(0, len(DBs_attacher[u])):                                                           # Sub-Block level iterator, n<=10 
-        attach_database(DBs_attacher[u][n], u, n)                                                      # Attach databases within block
+        [db_name, error] = next(prepared)                                                              # Wait for the database to be pre-processed
+        if error is not None:
+            print(f"WARNING: Pre-processing of {db_name} failed, it was not merged and was kept on disk.\n{error}")
+            failed_merges.append([db_name, "pre-processing"])
+            if (build_summaries and len(summary_well_columns) > 0):
+                wells_written += flush_well_summaries(well_summaries, well_donors, donor_wells[db_name],  # Its wells will not get any more objects
+                                                      summary_features, summary_well_columns, summary_quantiles)
+                conn.commit()
+            continue
+        attach_database(db_name, u, n)                                                                 # Attach databases within block
+        merged = True
         for j in range(0, len(listTable)):                                                             # for each table in each database
-            columns = list_to_string(get_column_names(listTable[j]), 1)                                # get each column for each table
-            merge_table(listTable[j], columns, listDB[u][n])                                           # and insert rows from these columns, in this database, in the equivalent table in main
+            column_names = get_column_names(listTable[j])                                              # get each column for each table
+            columns = list_to_string(column_names, 1)
+            [select_columns, missing] = get_select_columns(listTable[j], column_names, listDB[u][-1])   # with NULL for the columns this database lacks
+            if len(missing) > 0:
+                schema_drift[f"{db_name}.{listTable[j]}"] = missing
+            add_aggregates(merge_aggregates[listTable[j]],                                             # record the donor's row count and ID checksums as it is read
+                           get_table_aggregates(listTable[j], id_columns, listDB[u][-1]))
+            if not merge_table(listTable[j], columns, listDB[u][-1], merge_order.get(listTable[j]),    # and insert rows from these columns, in this database, in the equivalent table in main
+                               select_columns):
+                merged = False
+                failed_merges.append([db_name, listTable[j]])
             conn.commit()                                                                              # Commit changes one last time after a database in the block is done
-        os.remove(f"{DBs_attacher[u][n]}")                                                             # Removes merged db after the merge to conserve space on disk
+        if (build_summaries):
+            if merged:
+                summarize_donor(listDB[u][-1], summary_features, summary_image_key, summary_well_columns,  # Add the donor's objects to the image and well summaries
+                                summary_quantiles, summary_sketch_size, well_summaries, summary_join_key)
+            if len(summary_well_columns) > 0:
+                wells_written += flush_well_summaries(well_summaries, well_donors, donor_wells[db_name],   # Write the wells that have no databases left to merge
+                                                      summary_features, summary_well_columns, summary_quantiles)
+            conn.commit()
+        if (pack_features and merged):
+            pack_donor(listDB[u][-1], packed_features)                                                 # Add the donor's packed feature vectors
+            conn.commit()
+        if (build_spatial_index and merged):
+            if not index_donor(listDB[u][-1], spatial_columns, spatial_image_key):                     # Add the donor's objects to the spatial indexes
+                merged = False
+                failed_merges.append([db_name, "spatial index"])
+            conn.commit()
+        if merged:
+            os.remove(f"{db_name}")                                                                    # Removes merged db after the merge to conserve space on disk
+        else:
+            print(f"WARNING: {db_name} did not merge completely and was kept on disk.")
     close_connection()                                                                                 # Close connection at end of each block of ten databases
     print("Finished merging: "+str(u)+" of"+str(nBlocks)+". Time elapsed: %.3f" % (time.time() -
                                                                                    startTime))
 
+# 5.3 Write the per well summaries
+#### The per image summaries were written as each donor was merged, and each well was written once the last
+#### database with images of it was merged. Any well still in memory is written here
+
+if (build_summaries):
+    conn = sqlite3.connect(mainDB, timeout = 15)
+    curs = conn.cursor()
+    if len(summary_well_columns) > 0:
+        write_well_summaries(well_summaries, summary_features, summary_well_columns, summary_quantiles)
+        wells_written += len(well_summaries)
+        print(f"Wrote feature summaries for {wells_written} wells.")
+    else:
+        print("No well metadata columns found in Per_Image, only per image summaries were built.")
+    close_connection()
+
+# 5.4 Verify the merged output
+#### Checks the merged tables against the row counts and ID checksums recorded for mainDB and each donor
+#### in a single pass per table, rather than diffing rows or re-running the merge
+
+for y in range(0, len(failed_merges)):
+    print(f"{failed_merges[y][0]} failed to merge: {failed_merges[y][1]}.")
+run_metrics["failed_merges"] = failed_merges
+if len(schema_drift) > 0:
+    print(f"{len(schema_drift)} tables had columns missing from the union schema, these were filled with NULL (see {metrics_file}).")
+run_metrics["schema_drift"] = schema_drift
+
+if (verify_merge_output):
+    print("Verifying the merged database. Started at: " + strftime("%H:%M", gmtime()))
+    conn = sqlite3.connect(mainDB, timeout = 15)
+    curs = conn.cursor()
+    mismatches = verify_merge(merge_aggregates, id_columns)
+    close_connection()
+    for y in range(0, len(mismatches)):
+        print(f"WARNING: {mismatches[y][0]} does not match its donors. Expected: {mismatches[y][1]} Found: {mismatches[y][2]}")
+    if len(mismatches) == 0:
+        print(f"All {len(merge_aggregates)} merged tables match the row counts and ID checksums of their donors.")
+    run_metrics["verification"] = {"expected": merge_aggregates,
+                                   "mismatches": mismatches,
+                                   "passed": len(mismatches) == 0 and len(failed_merges) == 0}
+
+# 5.5 Grouped Per_Image layout
+#### Per_Image holds each image once, Per_Image is turned into a view with one row per GroupNumber block (see 2.14)
+
+if (do_grouping and group_image_mapping):
+    conn = sqlite3.connect(mainDB, timeout = 15)
+    curs = conn.cursor()
+    create_image_view()
+    close_connection()
+    print("Per_Image is now a view of Per_Image_Data (one row per image) and Per_Image_Groups (one row per GroupNumber block).")
 
 
 #################################################################################
@@ -793,6 +1895,8 @@ for u in range(0, len(DBs_attacher)):
 try:
     conn = sqlite3.connect(mainDB, timeout = 15)
     curs = conn.cursor()
+    set_storage_pragmas(storage_pragmas)
+    curs.execute("PRAGMA main.journal_mode = DELETE;") # leave the merged database as a single file
     print("Cleaning up the main database. Please wait...")
     curs.execute(f"VACUUM;")
 except Exception():
@@ -801,8 +1905,17 @@ except Exception():
 print("All databases finished merging. Time elapsed: %.3f" % (time.time() -
                                                           startTime))
 
+# 6.2 Write Run Metrics
+####
+####
+
+run_metrics["elapsed"] = time.time() - runStartTime # the whole run, from the integrity scan (3.1) on
+run_metrics["merge_elapsed"] = time.time() - startTime # pre-processing (4) to the end of the merge
+with open(metrics_file, 'w') as metricsFile:
+    json.dump(run_metrics, metricsFile, indent = 2)
+
 
-# 6.1 Run Post Processing Module
+# 6.3 Run Post Processing Module
 #### Run post-processing script to reintroduce column constraints for CPA
 #### 
 
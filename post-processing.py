@@ -109,6 +109,76 @@ def get_table_names():
             tables.append(temp[i][0])
     return tables
 
+# 7. Split the columns of a table into groups for vertical partitioning
+#
+# @param columns the column names to split (key columns excluded)
+# @param partition_by 'object' groups columns by object (i.e. "Nuclei" in "Nuclei_AreaShape_Area"),
+#        'measurement' groups them by measurement family (i.e. "AreaShape")
+# @param max_columns the largest number of columns in one group, bigger groups are split
+# @return a list of [group_name, [column names]], columns that fit no group go in the first group "Base"
+
+def get_column_groups(columns, partition_by, max_columns):
+    groups = {"Base": []}
+    for col in columns:
+        parts = col.split("_")
+        if (partition_by == 'measurement' and len(parts) > 2):
+            name = parts[1]
+        elif (partition_by == 'object' and len(parts) > 1):
+            name = parts[0]
+        else:
+            name = "Base"
+        groups.setdefault(name, []).append(col)
+    column_groups = []
+    for name in groups:
+        for k in range(0, max(len(groups[name]), 1), max_columns):
+            suffix = "" if k == 0 else f"_{k // max_columns + 1}"
+            column_groups.append([name + suffix, groups[name][k:k + max_columns]])
+    return column_groups
+
+# 8. Split a table into column-group tables that share its key columns, and replace it with a view
+#
+# @param table_name the name of the table to split (i.e. "Per_Object")
+# @param key_columns the columns every group table is keyed by (i.e. ["ImageNumber", "ObjectNumber"])
+# @param column_groups the groups from get_column_groups
+# @param constraints extra constraints for the first ("Base") table, i.e. a FOREIGN KEY clause
+# @param table_options i.e. " WITHOUT ROWID" to cluster the group tables on key_columns
+# @param order_by i.e. " ORDER BY ImageNumber, ObjectNumber" to fill clustered group tables in key order
+# @return none
+# group tables are named <table_name>_<group>, the view keeps the original column order so that
+# existing queries keep working, and only reads the group tables holding the columns they select
+
+def partition_table(table_name, key_columns, column_groups, constraints, table_options="", order_by=""):
+    colnam = get_column_names(table_name)
+    coltyp = dict(zip(colnam, get_column_types(table_name)))
+    for col in key_columns:
+        coltyp[col] = coltyp[col] + " NOT NULL"  # lets SQLite skip the joins to group tables a query does not use
+    keys = list_to_string(key_columns, 1)
+    owner = {}
+    for p in range(0, len(column_groups)):
+        group_table = f"{table_name}_{column_groups[p][0]}"
+        group_columns = key_columns + column_groups[p][1]
+        colnamtyp = list_to_string([[col, coltyp[col]] for col in group_columns], 2)
+        colnamtyp = colnamtyp + f", PRIMARY KEY ({keys})"
+        if (p == 0):
+            colnamtyp = colnamtyp + constraints
+        print(f"Creating {group_table} with {len(column_groups[p][1])} columns.")
+        curs.execute(f"DROP TABLE IF EXISTS {group_table};")
+        curs.execute(f"CREATE TABLE {group_table}({colnamtyp}){table_options};")
+        curs.execute(f"INSERT INTO {group_table}({list_to_string(group_columns, 1)}) SELECT {list_to_string(group_columns, 1)} FROM {table_name}{order_by};")
+        conn.commit()
+        for col in column_groups[p][1]:
+            owner[col] = f"p{p}"
+    for col in key_columns:
+        owner[col] = "p0"
+    select = list_to_string([f"{owner[col]}.{col}" for col in colnam], 1)
+    joins = f"{table_name}_{column_groups[0][0]} AS p0"
+    for p in range(1, len(column_groups)):
+        on = " AND ".join([f"p{p}.{col} = p0.{col}" for col in key_columns])
+        joins = joins + f" LEFT JOIN {table_name}_{column_groups[p][0]} AS p{p} ON {on}"
+    curs.execute(f"DROP TABLE {table_name};")
+    curs.execute(f"CREATE VIEW {table_name} AS SELECT {select} FROM {joins};")
+    conn.commit()
+
 #################################################################################
 ############################## Input Parameters #################################
 
@@ -116,6 +186,15 @@ def get_table_names():
 
 db = '/path/to/database.db'
 
+# Vertical partitioning of Per_Object (optional)
+# Splits a very wide Per_Object table into several tables keyed by (ImageNumber, ObjectNumber),
+# one per object ('object') or per measurement family ('measurement'), and replaces Per_Object with a
+# view that joins them back together. Queries that read a few columns only read the tables holding them.
+
+partition_per_object = False
+partition_by = 'object'
+partition_max_columns = 500
+
 #################################################################################
 ################################## Script #######################################
 
@@ -125,9 +204,26 @@ conn = sqlite3.connect(db)  # Connect to an original database version
 curs = conn.cursor()  # Connect a cursor
 listTable = ['Per_Image', 'Per_Object']
 
+# A grouped Per_Image view (group_image_mapping in MegaMergeScript.py) stays a view, the keys go on the tables under it
+curs.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = 'Per_Image';")
+image_view = curs.fetchone()
+image_table = 'Per_Image'
+if image_view is not None:
+    curs.execute("DROP VIEW Per_Image;")
+    listTable = ['Per_Image_Data', 'Per_Image_Groups', 'Per_Object']
+    image_table = 'Per_Image_Groups'
+
+# A clustered Per_Object (cluster_per_object in MegaMergeScript.py) stays a WITHOUT ROWID table clustered on
+# (ImageNumber, ObjectNumber), and so does each of its partitions
+curs.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'Per_Object';")
+object_table = curs.fetchone()
+cluster_per_object = object_table is not None and "WITHOUT ROWID" in object_table[0].upper()
+
 print("Processing Tables... Please wait, this may take some time.")
 for g in range(0, len(listTable)):
     print(f"Fetching table information for {db}.")
+    table_options = ""
+    order_by = ""
     coltyp   = get_column_types(listTable[g])
     colnam   = get_column_names(listTable[g])
 # Column Constraint Definitions for Specific Tables
@@ -138,22 +234,51 @@ for g in range(0, len(listTable)):
         colnamtyp = list(map(list, zip(colnam, coltyp)))
         colnamtyp = list_to_string(colnamtyp, 2)
         colnamtyp = colnamtyp + ', PRIMARY KEY (ImageNumber)'
+    if (listTable[g] == 'Per_Image_Data'):
+        print(f"Processing table constraints for {listTable[g]}.")
+        temp_idx = colnam.index("GroupNumber")
+        coltyp[temp_idx] = 'INTEGER UNIQUE'
+        colnamtyp = list(map(list, zip(colnam, coltyp)))
+        colnamtyp = list_to_string(colnamtyp, 2)
+        colnamtyp = colnamtyp + ', PRIMARY KEY (GroupNumber)'
+    if (listTable[g] == 'Per_Image_Groups'):
+        print(f"Processing table constraints for {listTable[g]}.")
+        temp_idx = colnam.index("ImageNumber")
+        coltyp[temp_idx] = 'INTEGER UNIQUE'
+        colnamtyp = list(map(list, zip(colnam, coltyp)))
+        colnamtyp = list_to_string(colnamtyp, 2)
+        colnamtyp = colnamtyp + ', PRIMARY KEY (ImageNumber), FOREIGN KEY (GroupNumber) REFERENCES Per_Image_Data (GroupNumber)'
     if (listTable[g] == 'Per_Object'):
         print(f"Processing table constraints for {listTable[g]}.")
         temp_idx = colnam.index("ImageNumber")
         coltyp[temp_idx] = 'INTEGER'
         temp_idx = colnam.index("ObjectNumber")
-        coltyp[temp_idx] = 'INTEGER UNIQUE'
+        coltyp[temp_idx] = 'INTEGER' if cluster_per_object else 'INTEGER UNIQUE'
         colnamtyp = list(map(list, zip(colnam, coltyp)))
         colnamtyp = list_to_string(colnamtyp, 2)
-        colnamtyp = colnamtyp + ', FOREIGN KEY (ImageNumber) REFERENCES Per_Image (ImageNumber)'
-        colnamtyp = colnamtyp + ', PRIMARY KEY (ObjectNumber)'
+        colnamtyp = colnamtyp + f', FOREIGN KEY (ImageNumber) REFERENCES {image_table} (ImageNumber)'
+        if (cluster_per_object):
+            colnamtyp = colnamtyp + ', PRIMARY KEY (ImageNumber, ObjectNumber)'
+            table_options = ' WITHOUT ROWID'
+            order_by = ' ORDER BY ImageNumber, ObjectNumber'
+        else:
+            colnamtyp = colnamtyp + ', PRIMARY KEY (ObjectNumber)'
     colnam = list_to_string(colnam, 1)
 # Table Modifications
     print(f"Finalizing alterations to {listTable[g]}...")
-    if (listTable[g] == 'Per_Image' or listTable[g] == 'Per_Object'):
-        curs.execute(f"CREATE TABLE _{listTable[g]}({colnamtyp});")
-        curs.execute(f"INSERT INTO _{listTable[g]}({colnam}) SELECT {colnam} FROM {listTable[g]};")
+    if (listTable[g] == 'Per_Object' and partition_per_object):
+        key_columns = ['ImageNumber', 'ObjectNumber']
+        column_groups = get_column_groups([col for col in get_column_names(listTable[g]) if col not in key_columns],
+                                          partition_by, partition_max_columns)
+        if (len(column_groups) > 64):
+            print(f"Can not partition {listTable[g]} into {len(column_groups)} tables, SQLite joins at most 64. Increase partition_max_columns.")
+            sys.exit()
+        partition_table(listTable[g], key_columns, column_groups,
+                        f', FOREIGN KEY (ImageNumber) REFERENCES {image_table} (ImageNumber)',
+                        table_options, order_by)
+    elif (listTable[g] in ['Per_Image', 'Per_Object', 'Per_Image_Data', 'Per_Image_Groups']):
+        curs.execute(f"CREATE TABLE _{listTable[g]}({colnamtyp}){table_options};")
+        curs.execute(f"INSERT INTO _{listTable[g]}({colnam}) SELECT {colnam} FROM {listTable[g]}{order_by};")
         curs.execute(f"DROP TABLE {listTable[g]};")
         curs.execute(f"ALTER TABLE _{listTable[g]} RENAME TO {listTable[g]};")
     else:
@@ -168,6 +293,10 @@ for g in range(0, len(listTable)):
     print(f"Processing of {listTable[g]} completed.")
     conn.commit()
 
+if image_view is not None:
+    curs.execute(image_view[0])
+    conn.commit()
+
 try:
     print("Cleaning up the database. Please wait...")
     curs.execute(f"VACUUM;")